@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+from checker import Checker, DataBackbone, BatchDataBackbone, InfluxDataBackbone, to_line_protocol
+
+class AsyncDataBackbone():
+    async def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
+        raise NotImplementedError()
+
+    async def get_rate(self, name, since, window="1s", unit="1s", **meta) -> pd.DataFrame:
+        raise NotImplementedError()
+
+    async def get_aggregate(self, name, since, func, **meta):
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+class AsyncInfluxDataBackbone(InfluxDataBackbone, AsyncDataBackbone):
+    """ InfluxDataBackbone that queries with the asyncio API of influxdb-client
+
+    The client is created on first use as it must be bound to the running event loop.
+    Requests are retried as InfluxDataBackbone retries them. Measurements are written
+    in the request that pushes them rather than queued to a writer thread.
+    """
+    def __init__(self, *args, **kargs):
+        super().__init__(*args, **kargs)
+        self.writer = None
+        self.written = 0
+        self.rejected = 0
+
+    def get_influx_client(self):
+        if self.influx_client == None:
+            from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+            self.influx_client = InfluxDBClientAsync(
+                url=self.influx_url,
+                token=self.influx_token,
+                org=self.influx_org,
+                debug=False
+            )
+        return self.influx_client
+
+    async def _reset_client(self):
+        client, self.influx_client = self.influx_client, None
+        if client != None:
+            await client.close()
+
+    async def ping(self) -> bool:
+        try:
+            self.healthy = await self.get_influx_client().ping()
+        except Exception:
+            self.healthy = False
+        return self.healthy
+
+    def _is_transient(self, ex: Exception) -> bool:
+        import aiohttp
+        return super()._is_transient(ex) or isinstance(ex, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def _request(self, func):
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = await func()
+            except Exception as ex:
+                with self._lock:
+                    self.failures += 1
+                if attempt >= self.retries or not self._is_transient(ex):
+                    raise
+                # the connections of the session may be broken; start over if InfluxDB is reachable again
+                if not await self.ping():
+                    await self._reset_client()
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                continue
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.requests += 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "healthy": self.healthy,
+                "requests": self.requests,
+                "failures": self.failures,
+                "retries": self.retried,
+                "latency_avg": self.latency_total / self.requests if self.requests > 0 else 0.,
+                "latency_max": self.latency_max,
+                "write_written": self.written,
+                "write_rejected": self.rejected,
+            }
+
+    async def query(self, query) -> pd.DataFrame:
+        data = await self._request(lambda: self.get_influx_client().query_api().query_raw(query, dialect=self.dialect))
+        return self.convert_to_api_record(self.parse_csv(data.encode()))
+
+    async def get_measurements(self, name, since="-1m", last=False, **meta):
+        query = self.query_builder(name, since, last, **meta)
+        return await self.query(query)
+
+    async def get_rate(self, name, since, window="1s", unit="1s", **meta):
+        aggregation = [f'aggregate.rate(every: {window}, unit: {unit})']
+        query = self.query_builder(name, since, last=False, additional_queries=aggregation, **meta)
+        return await self.query(query)
+
+    async def get_aggregate(self, name, since, func, **meta):
+        if func not in self.aggregate_queries:
+            raise NotImplementedError()
+        query = self.query_builder(name, since, last=False, additional_queries=self.aggregate_queries[func], **meta)
+        for table in await self._request(lambda: self.get_influx_client().query_api().query(query)):
+            for record in table.records:
+                return record.get_value()
+        return None
+
+    async def push_measurements(self, measurements: list) -> int:
+        """ Writes the measurements and returns the number of them written """
+        lines = []
+        rejected = 0
+        for m in measurements:
+            try:
+                lines.append(to_line_protocol(m))
+            except Exception:
+                rejected += 1
+        with self._lock:
+            self.rejected += rejected
+        if len(lines) > 0:
+            await self._request(lambda: self.get_influx_client().write_api().write(
+                bucket=self.influx_bucket,
+                org=self.influx_org,
+                record="\n".join(lines)))
+            with self._lock:
+                self.written += len(lines)
+        return len(lines)
+
+    async def flush(self, timeout=None) -> bool:
+        return True
+
+    async def close(self):
+        await self._reset_client()
+
+class SyncDataBackbone(DataBackbone):
+    """ Calls an AsyncDataBackbone from a thread other than its event loop's """
+    def __init__(self, backbone: AsyncDataBackbone, loop: asyncio.AbstractEventLoop):
+        self.backbone = backbone
+        self.loop = loop
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
+        return self._run(self.backbone.get_measurements(name, since, last, **meta))
+
+    def get_rate(self, name, since, window="1s", unit="1s", **meta) -> pd.DataFrame:
+        return self._run(self.backbone.get_rate(name, since, window, unit, **meta))
+
+    def get_aggregate(self, name, since, func, **meta):
+        return self._run(self.backbone.get_aggregate(name, since, func, **meta))
+
+class AsyncChecker(Checker):
+    """ Checker that evaluates rules against an AsyncDataBackbone
+
+    The backbone requests of a rule are sent concurrently before the rule is
+    evaluated, so that the evaluation waits for the slowest request rather than
+    the sum of them. Requests that can not be known before the evaluation,
+    such as v() with a computed name, are sent while evaluating.
+    """
+    def __init__(self, backbone: AsyncDataBackbone, rule_cache_size=256, executor=None):
+        super().__init__(backbone, rule_cache_size)
+        self.executor = executor
+
+    async def _fetch(self, batch: BatchDataBackbone, key, method, args, meta):
+        try:
+            batch.results[key] = await getattr(self.backbone, method)(*args, **meta)
+        except Exception:
+            # the request is sent again while evaluating to report the error
+            pass
+
+    async def _prefetch(self, batch: BatchDataBackbone, rules: list):
+        requests = {}
+        for rule in rules:
+            try:
+                calls = self.rule_cache.get(rule).calls
+            except Exception:
+                # the rule is compiled again while evaluating to report the error
+                continue
+            for method, args, meta in self.get_requests(calls):
+                try:
+                    requests.setdefault(batch.key(method, args, meta), (method, args, meta))
+                except TypeError:
+                    continue
+        await asyncio.gather(*[self._fetch(batch, key, *request) for key, request in requests.items()])
+
+    async def evaluate_many(self, rules: list) -> list:
+        """ Evaluates rules together, sending each distinct backbone query once and concurrently
+
+        Returns a list of (success, result) in the order of the given rules.
+        """
+        loop = asyncio.get_running_loop()
+        batch = BatchDataBackbone(SyncDataBackbone(self.backbone, loop))
+        await self._prefetch(batch, rules)
+        checker = self.with_backbone(batch)
+        # evaluation may still call the backbone and must not block the event loop
+        return await loop.run_in_executor(self.executor, lambda: [Checker.evaluate(checker, rule) for rule in rules])
+
+    async def evaluate(self, rule) -> Tuple[bool, any]:
+        results = await self.evaluate_many([rule])
+        return results[0]
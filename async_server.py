@@ -0,0 +1,83 @@
+from os import getenv
+
+from aiohttp import web
+from async_checker import AsyncChecker, AsyncInfluxDataBackbone
+
+from prometheus_client import start_http_server, Histogram, Gauge
+
+REQUEST_TIME = Histogram('request_processing_seconds', 'Time spent processing request')
+RULE_CACHE_HITS = Gauge('rule_cache_hits', 'Number of rule evaluations that reused a compiled rule')
+RULE_CACHE_MISSES = Gauge('rule_cache_misses', 'Number of rule evaluations that compiled the rule')
+
+port = int(getenv("SERVER_PORT", 5000))
+
+c = AsyncChecker(AsyncInfluxDataBackbone(
+    getenv("NODE_INFLUXDB_URL", "http://wes-node-influxdb:8086"),
+    getenv("NODE_INFLUXDB_QUERY_TOKEN", "")
+))
+RULE_CACHE_HITS.set_function(lambda: c.rule_cache.hits)
+RULE_CACHE_MISSES.set_function(lambda: c.rule_cache.misses)
+
+
+def generate_result(rule, success, message):
+    return {
+        "response": "success" if success else "failed",
+        "rule": rule,
+        "result" if success else "error": message,
+    }
+
+async def read_json(request):
+    if request.content_type == None or not request.content_type.startswith("application/json"):
+        return None
+    return await request.json()
+
+async def listrules(request):
+    return web.json_response({
+        "response": "success",
+        "rules": list(c.get_supported_funcs().keys())
+    })
+
+async def evaluate(request):
+    with REQUEST_TIME.time():
+        j = await read_json(request)
+        if j is None:
+            return web.json_response(generate_result("", False, "content_type must be application/json"))
+        rule = j.get("rule", "")
+        if rule == "":
+            return web.json_response(generate_result(rule, False, "no rule is given"))
+        ret, result = await c.evaluate(rule)
+        return web.json_response(generate_result(rule, ret, result))
+
+async def evaluate_batch(request):
+    with REQUEST_TIME.time():
+        j = await read_json(request)
+        if j is None:
+            return web.json_response(generate_result("", False, "content_type must be application/json"))
+        rules = j.get("rules", [])
+        if not isinstance(rules, list) or len(rules) < 1:
+            return web.json_response(generate_result("", False, "no rules are given"))
+        if not all(isinstance(rule, str) and rule != "" for rule in rules):
+            return web.json_response(generate_result("", False, "rules must be non-empty strings"))
+        results = await c.evaluate_many(rules)
+        return web.json_response({
+            "response": "success",
+            "results": [generate_result(rule, ret, result) for rule, (ret, result) in zip(rules, results)],
+        })
+
+async def close_backbone(app):
+    await c.backbone.close()
+
+def create_app():
+    app = web.Application()
+    app.add_routes([
+        web.get("/listrules", listrules),
+        web.post("/evaluate", evaluate),
+        web.post("/evaluate_batch", evaluate_batch),
+    ])
+    app.on_cleanup.append(close_backbone)
+    return app
+
+
+if __name__ == "__main__":
+    start_http_server(8000)
+    web.run_app(create_app(), host='0.0.0.0', port=port)
@@ -1,11 +1,146 @@
+from __future__ import annotations
+
+import ast
+import contextvars
+import copy
 import datetime
+import functools
+import importlib
+import io
+import json
+import math
+import operator
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from typing import Tuple
 
-import numpy as np
-import pandas as pd
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
-from croniter import croniter
+class LazyModule():
+    """ A module that is imported the first time one of its attributes is used
+
+    numpy and pandas take most of the startup time and memory of the checker,
+    while rules that only use time() or literals need neither of them. Once
+    imported, the module replaces the LazyModule in the globals of this module.
+    influxdb_client and croniter are imported where they are used.
+    """
+    def __init__(self, alias, name):
+        self._alias = alias
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+np = LazyModule("np", "numpy")
+pd = LazyModule("pd", "pandas")
+
+# columns of the DataFrame returned from DataBackbone; any other column is a tag
+RECORD_COLUMNS = ["timestamp", "name", "value", "meta"]
+
+def tag_columns(df: pd.DataFrame) -> list:
+    return [c for c in df.columns if c not in RECORD_COLUMNS and not c.startswith("_")]
+
+def get_meta(df: pd.DataFrame) -> list:
+    """ Returns meta of the records as a list of dicts
+
+    Records from InfluxDB keep their tags as columns; the dicts are built
+    only when asked for.
+    """
+    if "meta" in df.columns:
+        return df["meta"].tolist()
+    tags = df[tag_columns(df)]
+    # a tag missing from a series is empty in its table, or NaN once tables are merged
+    return [{k: v for k, v in row.items() if not pd.isna(v) and v != ""} for row in tags.to_dict("records")]
+
+def get_timedelta(since) -> datetime.timedelta:
+    if not isinstance(since, str):
+        raise Exception(f'{since} is not string')
+    if len(since) < 3:
+        raise Exception(f'{since}\'s length is too short')
+    unit = since[-1]
+    value = int(since[1:-1])
+    if unit == "s":
+        return datetime.timedelta(seconds=value)
+    elif unit == "m":
+        return datetime.timedelta(minutes=value)
+    elif unit == "h":
+        return datetime.timedelta(hours=value)
+    elif unit == "d":
+        return datetime.timedelta(days=value)
+    else:
+        raise Exception("Unit must be in [second, minute, hour, day]")
+
+# reduce_values computes an aggregate of DataBackbone.get_aggregate from values
+# as the rule would without planning; max and min also compare values that are not numbers
+def reduce_values(values: np.ndarray, func):
+    if func == "count":
+        return len(values)
+    elif func == "last":
+        return values[-1]
+    elif func == "max":
+        return values.max() if values.dtype.kind in "biuf" else max(values)
+    elif func == "min":
+        return values.min() if values.dtype.kind in "biuf" else min(values)
+    values = values.astype(float)
+    if func == "mean":
+        return values.mean()
+    elif func == "sum":
+        return values.sum()
+    raise NotImplementedError()
+
+class Profile():
+    """ Time spent in each stage of evaluations and the number of calls of supported functions
+
+    Stages are compile, query, conversion and evaluation. The time of a stage
+    excludes the time of the stages nested in it, so that the stages add up to
+    the time of the evaluation.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.calls = {}
+        self._stack = []
+
+    def start(self, stage):
+        self._stack.append([stage, time.perf_counter(), 0.])
+
+    def stop(self):
+        stage, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.stages[stage] = self.stages.get(stage, 0.) + elapsed - nested
+        if len(self._stack) > 0:
+            self._stack[-1][2] += elapsed
+
+    def count(self, func):
+        self.calls[func] = self.calls.get(func, 0) + 1
+
+    def to_dict(self) -> dict:
+        return {
+            "stages_ms": {k: round(v * 1000, 3) for k, v in self.stages.items()},
+            "calls": dict(self.calls),
+        }
+
+# the profile of the evaluation in progress, if any
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+@contextmanager
+def stage(name):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    profile.start(name)
+    try:
+        yield
+    finally:
+        profile.stop()
+
+# plugin executions are recorded by the scheduler with the plugin name as value
+LAST_EXECUTION = "sys.scheduler.plugin.lastexecution"
 
 class DataBackbone():
     def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
@@ -14,72 +149,476 @@ class DataBackbone():
     def get_rate(self, name, since, window="1s", unit="1s", **meta) -> pd.DataFrame:
         raise NotImplementedError()
 
-class FakeDataBackbone(DataBackbone):
-    def __init__(self, measurements: list):
-        self.data = pd.DataFrame(measurements)
-
-    def _get_timedelta(self, since) -> datetime.timedelta:
-        if not isinstance(since, str):
-            raise Exception(f'{since} is not string')
-        if len(since) < 3:
-            raise Exception(f'{since}\'s length is too short')
-        unit = since[-1]
-        value = int(since[1:-1])
-        if unit == "s":
-            return datetime.timedelta(seconds=value)
-        elif unit == "m":
-            return datetime.timedelta(minutes=value)
-        elif unit == "h":
-            return datetime.timedelta(hours=value)
-        elif unit == "d":
-            return datetime.timedelta(days=value)
+    # get_aggregate returns a single value reduced from the measurements by func
+    # (one of mean, max, min, count, sum, last) or None if there is no measurement
+    def get_aggregate(self, name, since, func, **meta):
+        raise NotImplementedError()
+
+class MeasurementBuffer():
+    """ Ring buffer of time-ordered measurements of a single name
+
+    Timestamps are kept in nanoseconds since epoch. The buffer grows by doubling
+    until it reaches capacity, after which the oldest measurement is overwritten.
+    """
+    def __init__(self, capacity, initial_size=16):
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        n = min(initial_size, capacity)
+        self.timestamps = np.zeros(n, dtype=np.int64)
+        self.values = np.empty(n, dtype=object)
+        self.metas = np.empty(n, dtype=object)
+
+    def __len__(self):
+        return self.size
+
+    def _physical(self, i):
+        return (self.start + i) % len(self.timestamps)
+
+    def _reset(self, timestamps, values, metas, size):
+        # arrays are given in logical order
+        self.timestamps, self.values, self.metas = timestamps, values, metas
+        self.start = 0
+        self.size = size
+
+    def _resize(self, n):
+        timestamps, values, metas = self.slice(0, self.size)
+        self._reset(np.zeros(n, dtype=np.int64), np.empty(n, dtype=object), np.empty(n, dtype=object), self.size)
+        self.timestamps[:self.size], self.values[:self.size], self.metas[:self.size] = timestamps, values, metas
+
+    def bisect(self, timestamp) -> int:
+        """ Returns the logical index of the first measurement newer than timestamp """
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._physical(mid)] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def append(self, timestamp, value, meta):
+        if self.size > 0 and timestamp < self.timestamps[self._physical(self.size - 1)]:
+            self._insert(timestamp, value, meta)
+            return
+        if self.size == len(self.timestamps) and self.size < self.capacity:
+            self._resize(min(self.size * 2, self.capacity))
+        if self.size == self.capacity:
+            # overwrite the oldest
+            i = self.start
+            self.start = self._physical(1)
         else:
-            raise Exception("Unit must be in [second, minute, hour, day]")
+            i = self._physical(self.size)
+            self.size += 1
+        self.timestamps[i], self.values[i], self.metas[i] = timestamp, value, meta
+
+    def _insert(self, timestamp, value, meta):
+        # out-of-order measurements are rare; rebuild the buffer around them
+        i = self.bisect(timestamp)
+        timestamps, values, metas = self.slice(0, self.size)
+        timestamps = np.insert(timestamps, i, timestamp)
+        values = np.insert(values, i, None)
+        values[i] = value
+        metas = np.insert(metas, i, None)
+        metas[i] = meta
+        n = len(timestamps)
+        if n > self.capacity:
+            timestamps, values, metas, n = timestamps[1:], values[1:], metas[1:], n - 1
+        self._reset(timestamps, values, metas, n)
+        if len(self.timestamps) < min(n * 2, self.capacity):
+            self._resize(min(n * 2, self.capacity))
+
+    def slice(self, lo, hi) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns copies of timestamps, values and metas in [lo, hi) of logical order """
+        idx = (self.start + np.arange(lo, hi)) % len(self.timestamps)
+        return self.timestamps[idx], self.values[idx], self.metas[idx]
+
+class MemoryDataBackbone(DataBackbone):
+    """ In-process backbone that keeps recent measurements in memory
+
+    Measurements are indexed by name and kept in a ring buffer of up to
+    max_points per name. A since window is looked up by binary search.
+    """
+    def __init__(self, measurements: list = [], max_points=100000):
+        self.max_points = max_points
+        self.buffers = {}
+        self._lock = threading.Lock()
+        self.push_measurements(measurements)
+
+    def _to_nanoseconds(self, timestamp) -> int:
+        if timestamp is None:
+            return time.time_ns()
+        return pd.Timestamp(timestamp).value
 
     def push_measurements(self, measurements: list):
-        df = pd.DataFrame(measurements)
-        self.data = self.data.append(df)
+        with self._lock:
+            for m in measurements:
+                if "name" not in m or "value" not in m:
+                    continue
+                buffer = self.buffers.get(m["name"])
+                if buffer is None:
+                    buffer = self.buffers[m["name"]] = MeasurementBuffer(self.max_points)
+                buffer.append(self._to_nanoseconds(m.get("timestamp")), m["value"], m.get("meta", {}))
+
+    def _select(self, name, since, last, meta) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        value = meta.pop("_value", None)
+        cutoff = time.time_ns() - get_timedelta(since) // datetime.timedelta(microseconds=1) * 1000
+        with self._lock:
+            buffer = self.buffers.get(name)
+            if buffer is None:
+                timestamps, values, metas = np.zeros(0, dtype=np.int64), np.empty(0, dtype=object), np.empty(0, dtype=object)
+            else:
+                timestamps, values, metas = buffer.slice(buffer.bisect(cutoff), len(buffer))
+        mask = np.ones(len(timestamps), dtype=bool)
+        if value not in [None, ""]:
+            mask &= values == value
+        if len(meta) > 0:
+            mask &= np.fromiter((all(k in m and m[k] == v for k, v in meta.items()) for m in metas), dtype=bool, count=len(metas))
+        timestamps, values, metas = timestamps[mask], values[mask], metas[mask]
+        if last:
+            return timestamps[-1:], values[-1:], metas[-1:]
+        return timestamps, values, metas
 
     def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
-        delta = self._get_timedelta(since)
-        d = self.data[self.data.timestamp > datetime.datetime.now(datetime.timezone.utc) - delta]
-        if meta.get("_value") not in [None, ""]:
-            v = meta.pop("_value")
-            meta["value"] = v
-            return d[(d.name==name) & (d.value==v)]
-        return d[d.name==name]
+        timestamps, values, metas = self._select(name, since, last, meta)
+        return pd.DataFrame({
+            "timestamp": pd.to_datetime(timestamps, unit="ns", utc=True),
+            "name": name,
+            "value": values,
+            "meta": metas,
+        }, columns=["timestamp", "name", "value", "meta"])
+
+    def get_aggregate(self, name, since, func, **meta):
+        _, values, _ = self._select(name, since, func == "last", meta)
+        if len(values) < 1:
+            return None
+        return reduce_values(values, func)
 
     def time_conversion_for_pandas(self, t) -> str:
         if t[-1] == "s":
-            return t[:-1] + "S"
+            return t[:-1] + "s"
         elif t[-1] == "m":
             return t[:-1] + "min"
         elif t[-1] == "h":
-            return t[:-1] + "H"
+            return t[:-1] + "h"
         else:
             return t
 
     def get_rate(self, name, since, window="1s", unit="1s", **meta):
         df = self.get_measurements(name, since, **meta)
-        return df.groupby(pd.Grouper(key="timestamp", freq=self.time_conversion_for_pandas(window))).mean().diff()
-       
+        df["value"] = pd.to_numeric(df["value"])
+        return df.groupby(pd.Grouper(key="timestamp", freq=self.time_conversion_for_pandas(window)))["value"].mean().diff().reset_index()
+
+class FakeDataBackbone(MemoryDataBackbone):
+    """ MemoryDataBackbone seeded with the given measurements for tests """
+    def __init__(self, measurements: list):
+        super().__init__(measurements)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# tag keys and values repeat across measurements
+@functools.lru_cache(maxsize=4096)
+def _escape(s, characters) -> str:
+    s = str(s)
+    if "\n" in s:
+        raise Exception(f'{s!r} must not contain a newline')
+    for c in characters:
+        s = s.replace(c, "\\" + c)
+    return s
+
+def to_line_protocol(measurement: dict) -> str:
+    """ Returns the measurement as a line of InfluxDB line protocol
+
+    The value is written to the field "value" and the meta to tags, as Point
+    would write them. An Exception is raised for a measurement that can not be written.
+    """
+    if "name" not in measurement:
+        raise Exception("name not found")
+    if "value" not in measurement:
+        raise Exception("value not found")
+    value = measurement["value"]
+    if type(value) is float:
+        if not math.isfinite(value):
+            raise Exception(f'value {value} is not finite')
+        field = repr(value)
+    elif isinstance(value, (bool, np.bool_)):
+        field = "true" if value else "false"
+    elif isinstance(value, (int, np.integer)):
+        field = f'{int(value)}i'
+    elif isinstance(value, (float, np.floating)):
+        if not np.isfinite(value):
+            raise Exception(f'value {value} is not finite')
+        field = repr(float(value))
+    elif isinstance(value, str):
+        field = '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    else:
+        raise Exception(f'value of type {type(value).__name__} is not supported')
+    line = _escape(measurement["name"], ", ")
+    for k, v in sorted(measurement.get("meta", {}).items()):
+        # InfluxDB does not store empty tags
+        if v is None or v == "":
+            continue
+        line += f',{_escape(k, ",= ")}={_escape(v, ",= ")}'
+    line += f' value={field}'
+    if measurement.get("timestamp") is not None:
+        timestamp = measurement["timestamp"]
+        if isinstance(timestamp, datetime.datetime) and not isinstance(timestamp, pd.Timestamp):
+            # naive datetimes are taken as UTC like Point does
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            timestamp = (timestamp - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+        elif not isinstance(timestamp, (int, np.integer)):
+            timestamp = pd.Timestamp(timestamp)
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.tz_localize("UTC")
+            timestamp = timestamp.value
+        line += f' {int(timestamp)}'
+    return line
+
+class InfluxWriter():
+    """ Writes measurements to InfluxDB in batches from a background thread
+
+    Measurements are serialized to line protocol and queued when written. A batch
+    is sent when batch_size lines are queued or flush_interval seconds have passed.
+    Measurements that can not be serialized are rejected, and those that do not fit
+    in the queue of max_queue lines or whose batch failed after retries are dropped.
+    """
+    def __init__(self, backbone, batch_size=5000, flush_interval=1, max_queue=100000):
+        self.backbone = backbone
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.batches = 0
+        self._queue = deque()
+        self._pending = 0
+        self._flushing = False
+        self._closed = False
+        self._write_api = None
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def write(self, measurements: list) -> int:
+        """ Queues the measurements and returns the number of them queued """
+        lines = []
+        rejected = 0
+        for m in measurements:
+            try:
+                lines.append(to_line_protocol(m))
+            except Exception:
+                rejected += 1
+        with self._condition:
+            self.rejected += rejected
+            space = max(self.max_queue - len(self._queue), 0)
+            if len(lines) > space:
+                self.dropped += len(lines) - space
+                lines = lines[:space]
+            self._queue.extend(lines)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="influxdb-writer", daemon=True)
+                self._thread.start()
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify_all()
+        return len(lines)
+
+    def _send(self, batch: list):
+        if self._write_api is None:
+            from influxdb_client.client.write_api import SYNCHRONOUS
+            self._write_api = self.backbone.get_influx_client().write_api(write_options=SYNCHRONOUS)
+        record = "\n".join(batch)
+        try:
+            self.backbone._request(lambda: self._write_api.write(
+                bucket=self.backbone.influx_bucket,
+                org=self.backbone.influx_org,
+                record=record))
+        except Exception:
+            with self._condition:
+                self.dropped += len(batch)
+            return
+        with self._condition:
+            self.written += len(batch)
+            self.batches += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._queue) >= self.batch_size or self._flushing or self._closed, self.flush_interval)
+                if len(self._queue) < 1:
+                    self._flushing = False
+                    self._condition.notify_all()
+                    if self._closed:
+                        self._thread = None
+                        return
+                    continue
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._pending = len(batch)
+            self._send(batch)
+            with self._condition:
+                self._pending = 0
+                self._condition.notify_all()
+
+    def flush(self, timeout=None) -> bool:
+        """ Waits until the queued measurements are sent; returns False on timeout """
+        with self._condition:
+            if self._thread is None:
+                return len(self._queue) < 1
+            self._flushing = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: len(self._queue) < 1 and self._pending == 0, timeout)
+
+    def close(self, timeout=None):
+        """ Sends the queued measurements and stops the background thread """
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "written": self.written,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "queued": len(self._queue) + self._pending,
+            }
+
 class InfluxDataBackbone(DataBackbone):
-    def __init__(self, influx_url, influx_token, influx_org='waggle', influx_bucket='waggle'):
+    """ DataBackbone on InfluxDB
+
+    One client and its HTTP connection pool are reused for all requests.
+    The connection is checked only after a failed request, or periodically
+    in the background when start_health_check is called. Requests failed by
+    a connection error or a 5xx/429 response are retried with exponential backoff.
+    Measurements are pushed in batches by an InfluxWriter.
+    """
+    def __init__(self, influx_url, influx_token, influx_org='waggle', influx_bucket='waggle', pool_size=10, retries=3, backoff=0.2,
+                 write_batch_size=5000, write_flush_interval=1, write_queue_size=100000):
         self.influx_url = influx_url
         self.influx_token = influx_token
         self.influx_org = influx_org
         self.influx_bucket = influx_bucket
         self.influx_client = None
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.latency_total = 0.
+        self.latency_max = 0.
+        self._query_api = None
+        self._lock = threading.Lock()
+        self._health_check = None
+        self.writer = InfluxWriter(self, batch_size=write_batch_size, flush_interval=write_flush_interval, max_queue=write_queue_size)
 
     def get_influx_client(self):
-        if self.influx_client == None or not self.influx_client.ping():
-            self.influx_client = InfluxDBClient(
-                url=self.influx_url,
-                token=self.influx_token,
-                org=self.influx_org,
-                debug=False
-            )
-        return self.influx_client
+        with self._lock:
+            if self.influx_client == None:
+                from influxdb_client import InfluxDBClient
+                self.influx_client = InfluxDBClient(
+                    url=self.influx_url,
+                    token=self.influx_token,
+                    org=self.influx_org,
+                    debug=False,
+                    connection_pool_maxsize=self.pool_size,
+                )
+                self._query_api = self.influx_client.query_api()
+            return self.influx_client
+
+    def get_query_api(self):
+        self.get_influx_client()
+        return self._query_api
+
+    def _reset_client(self):
+        with self._lock:
+            if self.influx_client != None:
+                self.influx_client.close()
+            self.influx_client = None
+            self._query_api = None
+
+    def ping(self) -> bool:
+        try:
+            self.healthy = self.get_influx_client().ping()
+        except Exception:
+            self.healthy = False
+        return self.healthy
+
+    def _is_transient(self, ex: Exception) -> bool:
+        import urllib3
+        from influxdb_client.rest import ApiException
+        if isinstance(ex, ApiException):
+            return ex.status is None or ex.status >= 500 or ex.status == 429
+        return isinstance(ex, (urllib3.exceptions.HTTPError, ConnectionError, TimeoutError))
+
+    def _request(self, func):
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = func()
+            except Exception as ex:
+                with self._lock:
+                    self.failures += 1
+                if attempt >= self.retries or not self._is_transient(ex):
+                    raise
+                # the connections in the pool may be broken; start over if InfluxDB is reachable again
+                if not self.ping():
+                    self._reset_client()
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                continue
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.requests += 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+            return result
+
+    def start_health_check(self, interval=30):
+        """ Pings InfluxDB every interval seconds in a background thread """
+        def check(stop: threading.Event):
+            while not stop.wait(interval):
+                self.ping()
+        if self._health_check is None:
+            stop = threading.Event()
+            thread = threading.Thread(target=check, args=(stop,), name="influxdb-health-check", daemon=True)
+            thread.start()
+            self._health_check = stop
+
+    def stop_health_check(self):
+        if self._health_check is not None:
+            self._health_check.set()
+            self._health_check = None
+
+    def stats(self) -> dict:
+        connections = idle = 0
+        with self._lock:
+            if self.influx_client != None:
+                pools = self.influx_client.api_client.rest_client.pool_manager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+                        idle += pool.pool.qsize() if pool.pool is not None else 0
+            stats = {
+                "healthy": self.healthy,
+                "requests": self.requests,
+                "failures": self.failures,
+                "retries": self.retried,
+                "latency_avg": self.latency_total / self.requests if self.requests > 0 else 0.,
+                "latency_max": self.latency_max,
+                "pool_size": self.pool_size,
+                "pool_connections": connections,
+                "pool_idle": idle,
+            }
+        stats.update({f'write_{k}': v for k, v in self.writer.stats().items()})
+        return stats
 
     def query_builder(self, name, since, last, additional_queries=[], **meta):
         headers = """import "experimental/aggregate"
@@ -96,72 +635,1267 @@ class InfluxDataBackbone(DataBackbone):
             q.append('last()')
         return headers + ' |> '.join(q)
 
-    def _add_meta(self, row: pd.Series):
-        return row.to_dict()
+    # only the datatype annotation is asked for, to parse the columns by their type
+    _dialect = None
+
+    @property
+    def dialect(self):
+        if InfluxDataBackbone._dialect is None:
+            from influxdb_client import Dialect
+            InfluxDataBackbone._dialect = Dialect(header=True, annotations=["datatype"], date_time_format="RFC3339Nano")
+        return InfluxDataBackbone._dialect
+
+    # datatypes of annotated CSV that are not kept as strings
+    datatypes = {
+        "double": lambda s: pd.to_numeric(s.mask(s == "")),
+        "long": lambda s: pd.to_numeric(s.mask(s == "")),
+        "unsignedLong": lambda s: pd.to_numeric(s.mask(s == "")),
+        "boolean": lambda s: s.map({"true": True, "false": False}),
+    }
+
+    def parse_block(self, block: bytes) -> pd.DataFrame:
+        datatypes = []
+        while block.startswith(b"#"):
+            line, _, block = block.partition(b"\n")
+            if line.startswith(b"#datatype,"):
+                datatypes = line.rstrip(b"\r").decode().split(",")
+        # every column is read as strings so that tags like port=1 or NA are kept as they are
+        df = pd.read_csv(io.BytesIO(block), dtype=str, keep_default_na=False)
+        # errors of the query at runtime are sent as a table of error and reference
+        if "error" in df.columns:
+            raise Exception(f'InfluxDB query failed: {df["error"].iloc[0] if len(df) > 0 else "unknown error"}')
+        if len(datatypes) == 0:
+            # without annotations _value is parsed as a number only if all of them are
+            if "_value" in df.columns:
+                try:
+                    df["_value"] = self.datatypes["double"](df["_value"])
+                except ValueError:
+                    pass
+            return df
+        for column, datatype in zip(df.columns, datatypes):
+            if datatype in self.datatypes:
+                df[column] = self.datatypes[datatype](df[column])
+        return df
+
+    def parse_csv(self, data: bytes) -> pd.DataFrame:
+        """ Parses the CSV response of a Flux query into a DataFrame
+
+        Tables with different columns are separated by an empty line and
+        come with their own annotations and header.
+        """
+        blocks = [b for b in re.split(rb"\r?\n\r?\n", data) if b.strip() != b""]
+        if len(blocks) < 1:
+            return pd.DataFrame(columns=["timestamp", "name", "value"])
+        dfs = [self.parse_block(b) for b in blocks]
+        df = dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+        # the first column of the response has no name
+        return df.drop(columns=[c for c in df.columns if c.startswith("Unnamed:") or c in ["result", "table"]])
 
     """ Converts InfluxDB DataFrame into Waggle DataFrame
+
+    Tags stay as columns of the DataFrame. Use get_meta to get them as dicts.
     """
     def convert_to_api_record(self, df: pd.DataFrame):
-        meta_df = df.loc[:, ~df.columns.str.contains("_")]
-        df.rename(columns={"_measurement": "name", "_value": "value", "_time": "timestamp"}, inplace=True)
-        df.loc[:, "meta"] = meta_df.apply(lambda row: self._add_meta(row), axis=1)
+        df = df.rename(columns={"_measurement": "name", "_value": "value", "_time": "timestamp"})
+        if "timestamp" in df.columns:
+            df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True, format="ISO8601")
         return df
 
+    def query(self, query) -> pd.DataFrame:
+        response = self._request(lambda: self.get_query_api().query_raw(query, dialect=self.dialect))
+        try:
+            data = response.data
+        finally:
+            response.release_conn()
+        with stage("conversion"):
+            return self.convert_to_api_record(self.parse_csv(data))
+
+    # all series are merged into one table before the aggregation,
+    # so that the aggregate is computed over every matching measurement
+    aggregate_queries = {
+        "mean": ['group()', 'mean()'],
+        "max": ['group()', 'max()'],
+        "min": ['group()', 'min()'],
+        "count": ['group()', 'count()'],
+        "sum": ['group()', 'sum()'],
+        "last": ['group()', 'sort(columns: ["_time"])', 'last()'],
+    }
+
+    def get_aggregate(self, name, since, func, **meta):
+        if func not in self.aggregate_queries:
+            raise NotImplementedError()
+        query = self.query_builder(name, since, last=False, additional_queries=self.aggregate_queries[func], **meta)
+        for table in self._request(lambda: self.get_query_api().query(query)):
+            for record in table.records:
+                return record.get_value()
+        return None
+
     def get_measurements(self, name, since="-1m", last=False, **meta):
-        client = self.get_influx_client()
         query = self.query_builder(name, since, last, **meta)
-        df = client.query_api().query_data_frame(query)
-        if type(df) == list:
-            df = pd.concat(df)
-        return self.convert_to_api_record(df)
+        return self.query(query)
 
     def get_rate(self, name, since, window="1s", unit="1s", **meta):
-        client = self.get_influx_client()
         aggregation = [f'aggregate.rate(every: {window}, unit: {unit})']
         query = self.query_builder(name, since, last=False, additional_queries=aggregation, **meta)
-        df = client.query_api().query_data_frame(query)
-        if type(df) == list:
-            df = pd.concat(df)
-        return self.convert_to_api_record(df)
-
-    def _generate_point(self, measurement:dict):
-        if "name" not in measurement:
-            return "name not found"
-        if "value" not in measurement:
-            return "value not found"
-        p = Point(measurement["name"]).field("value", measurement["value"])
-        if "timestamp" in measurement:
-            p.time(measurement["timestamp"])
-        if "meta" in measurement:
-            for k, v in measurement["meta"].items():
-                p.tag(k, v)
-        return p
+        return self.query(query)
 
-    def push_measurements(self, measurements: list):
-        client = self.get_influx_client()
-        with client.write_api(write_options=SYNCHRONOUS) as write_api:
-            points = []
-            for m in measurements:
-                p = self._generate_point(m)
-                if isinstance(p, str):
-                    pass
-                else:
-                    points.append(p)
-            write_api.write(
-                bucket=self.influx_bucket,
-                org=self.influx_org,
-                record=points)
+    def push_measurements(self, measurements: list) -> int:
+        """ Queues the measurements to be written and returns the number of them queued
+
+        Call flush to wait until they are written.
+        """
+        return self.writer.write(measurements)
+
+    def flush(self, timeout=None) -> bool:
+        return self.writer.flush(timeout)
+
+class BatchDataBackbone(DataBackbone):
+    """ Shares backbone queries among rules evaluated together
+
+    Each distinct request is sent to the wrapped backbone only once;
+    repeated requests return the DataFrame of the first request.
+    """
+    def __init__(self, backbone: DataBackbone):
+        self.backbone = backbone
+        self.results = {}
+        self.queries = 0
+
+    @staticmethod
+    def key(method, args, meta) -> tuple:
+        key = (method, tuple(args), tuple(sorted(meta.items())))
+        hash(key)
+        return key
+
+    def _request(self, func, *args, **meta):
+        try:
+            key = self.key(func.__name__, args, meta)
+        except TypeError:
+            self.queries += 1
+            return func(*args, **meta)
+        if key not in self.results:
+            self.queries += 1
+            self.results[key] = func(*args, **meta)
+        return self.results[key]
+
+    def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
+        return self._request(self.backbone.get_measurements, name, since, last, **meta)
+
+    def get_rate(self, name, since, window="1s", unit="1s", **meta) -> pd.DataFrame:
+        return self._request(self.backbone.get_rate, name, since, window, unit, **meta)
+
+    def get_aggregate(self, name, since, func, **meta):
+        return self._request(self.backbone.get_aggregate, name, since, func, **meta)
+
+class CachedWindow():
+    """ The most recent window of measurements fetched for a cache key """
+    def __init__(self, df: pd.DataFrame, span: datetime.timedelta, fetched_at: float):
+        self.df = df
+        self.span = span
+        self.created_at = fetched_at
+        self.fetched_at = fetched_at
+        self.watermark = df["timestamp"].max() if len(df) > 0 else None
+        self.row_size = df.memory_usage(index=True, deep=True).sum() / len(df) if len(df) > 0 else 0
+        self.size = 0
+        self.update_size()
+
+    def update_size(self):
+        if self.row_size == 0 and len(self.df) > 0:
+            self.row_size = self.df.memory_usage(index=True, deep=True).sum() / len(self.df)
+        self.size = int(self.row_size * len(self.df))
+
+class CachingDataBackbone(DataBackbone):
+    """ Caches windows of measurements in front of another backbone
+
+    The most recent window is kept per (name, meta, last). A repeated request
+    fetches only the measurements newer than the latest cached timestamp and
+    slices the window to the requested since. A window is fetched fully again
+    after its TTL, or when a longer since is requested. Windows are evicted
+    in least recently used order when the cache grows beyond max_bytes.
+    hits counts requests served without a query, deltas those that fetched
+    only the new measurements and misses those that fetched a full window.
+    """
+    def __init__(self, backbone: DataBackbone, ttl=60, ttls=None, max_bytes=64 * 1024 * 1024, min_interval=0):
+        self.backbone = backbone
+        self.ttl = ttl
+        # ttls overrides ttl per measurement name
+        self.ttls = {} if ttls is None else ttls
+        self.max_bytes = max_bytes
+        # a window fetched within min_interval seconds is served without a query
+        self.min_interval = min_interval
+        self.windows = OrderedDict()
+        self.hits = 0
+        self.deltas = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def _key(self, name, meta, last):
+        key = (name, tuple(sorted(meta.items())), last)
+        hash(key)
+        return key
+
+    # _fresh returns whether a request of the window would be served without a query
+    def _fresh(self, key, name, since) -> bool:
+        now = time.time()
+        with self._lock:
+            window = self.windows.get(key)
+            return window is not None and now - window.created_at <= self.ttls.get(name, self.ttl) and \
+                get_timedelta(since) <= window.span and now - window.fetched_at < self.min_interval
+
+    def _since(self, seconds) -> str:
+        return f'-{int(np.ceil(seconds)) + 1}s'
+
+    def _last_per_series(self, df: pd.DataFrame) -> pd.DataFrame:
+        if "meta" in df.columns:
+            series = [tuple(sorted(m.items())) if isinstance(m, dict) else () for m in df["meta"]]
+        else:
+            series = list(df[tag_columns(df)].itertuples(index=False, name=None))
+        df = df.assign(_series=series).sort_values("timestamp", kind="stable")
+        return df.drop_duplicates(subset=["name", "_series"], keep="last").drop(columns=["_series"])
+
+    def _fetch(self, key, name, since, last, meta) -> pd.DataFrame:
+        span = get_timedelta(since)
+        now = time.time()
+        with self._lock:
+            window = self.windows.get(key)
+            if window is not None:
+                self.windows.move_to_end(key)
+            ttl = self.ttls.get(name, self.ttl)
+            stale = window is None or now - window.created_at > ttl or span > window.span
+            if not stale and now - window.fetched_at < self.min_interval:
+                self.hits += 1
+                return window.df
+        if stale:
+            df = self.backbone.get_measurements(name, since, last, **meta)
+            with self._lock:
+                self.misses += 1
+                self._store(key, CachedWindow(df, span, now))
+            return df
+        # fetch the measurements since the last one we have seen
+        watermark = window.watermark
+        seconds = now - (watermark.timestamp() if watermark is not None else window.fetched_at)
+        delta = self.backbone.get_measurements(name, self._since(seconds), last, **meta)
+        with self._lock:
+            self.deltas += 1
+            if window.watermark is not None and len(delta) > 0:
+                delta = delta[delta["timestamp"] > window.watermark]
+            df = window.df
+            if len(delta) > 0:
+                df = pd.concat([df, delta], ignore_index=True) if len(df) > 0 else delta
+                if last:
+                    df = self._last_per_series(df)
+            cutoff = pd.Timestamp(now - window.span.total_seconds(), unit="s", tz="UTC")
+            if len(df) > 0 and df["timestamp"].min() <= cutoff:
+                df = df[df["timestamp"] > cutoff]
+            window.df = df
+            window.fetched_at = now
+            if len(delta) > 0:
+                window.watermark = delta["timestamp"].max() if window.watermark is None else max(window.watermark, delta["timestamp"].max())
+            self.size -= window.size
+            window.update_size()
+            self.size += window.size
+            self._evict(key)
+        return df
+
+    def _store(self, key, window: CachedWindow):
+        old = self.windows.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        self.windows[key] = window
+        self.size += window.size
+        self._evict(key)
+
+    def _evict(self, keep):
+        for key in list(self.windows.keys()):
+            if self.size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.size -= self.windows.pop(key).size
+            self.evictions += 1
+
+    def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
+        try:
+            key = self._key(name, meta, last)
+        except TypeError:
+            return self.backbone.get_measurements(name, since, last, **meta)
+        df = self._fetch(key, name, since, last, meta)
+        if len(df) < 1:
+            return df
+        cutoff = pd.Timestamp.now(tz="UTC") - get_timedelta(since)
+        return df[df["timestamp"] > cutoff]
+
+    def get_rate(self, name, since, window="1s", unit="1s", **meta) -> pd.DataFrame:
+        return self.backbone.get_rate(name, since, window, unit, **meta)
+
+    # aggregates are computed from the cached window only when it is served without a query,
+    # as the backbone returns the aggregate faster than the measurements to compute it from
+    def get_aggregate(self, name, since, func, **meta):
+        try:
+            fresh = self._fresh(self._key(name, meta, func == "last"), name, since)
+        except TypeError:
+            fresh = False
+        if not fresh:
+            return self.backbone.get_aggregate(name, since, func, **meta)
+        df = self.get_measurements(name, since, func == "last", **meta)
+        if len(df) < 1:
+            return None
+        if func == "last":
+            df = df.sort_values("timestamp", kind="stable")
+        return reduce_values(df["value"].to_numpy(), func)
+
+    def clear(self):
+        with self._lock:
+            self.windows.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "deltas": self.deltas,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "windows": len(self.windows),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+class RollingWindow():
+    """ Count, sum, min, max and last of the values in a sliding time window
+
+    Values are added in time order and evicted when they fall out of the window.
+    Both take amortized O(1); min and max are kept with monotonic deques.
+    """
+    def __init__(self):
+        self.points = deque()
+        self.mins = deque()
+        self.maxs = deque()
+        self.total = 0.
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, timestamp, value):
+        self.points.append((timestamp, value))
+        self.total += value
+        while len(self.mins) > 0 and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((timestamp, value))
+        while len(self.maxs) > 0 and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((timestamp, value))
+
+    def evict(self, cutoff):
+        """ Removes the values at or before cutoff """
+        while len(self.points) > 0 and self.points[0][0] <= cutoff:
+            _, value = self.points.popleft()
+            self.total -= value
+        while len(self.mins) > 0 and self.mins[0][0] <= cutoff:
+            self.mins.popleft()
+        while len(self.maxs) > 0 and self.maxs[0][0] <= cutoff:
+            self.maxs.popleft()
+
+    def empty(self, cutoff):
+        return len(self.points) < 1
+
+    @staticmethod
+    def merge(windows: list, func):
+        """ Returns the aggregate of the values of all given windows """
+        windows = [w for w in windows if len(w) > 0]
+        if len(windows) < 1:
+            return None
+        if func == "count":
+            return sum(len(w) for w in windows)
+        elif func == "sum":
+            return sum(w.total for w in windows)
+        elif func == "mean":
+            return sum(w.total for w in windows) / sum(len(w) for w in windows)
+        elif func == "min":
+            return min(w.get("min") for w in windows)
+        elif func == "max":
+            return max(w.get("max") for w in windows)
+        elif func == "last":
+            return max(windows, key=lambda w: w.points[-1][0]).get("last")
+        raise NotImplementedError()
+
+    def get(self, func):
+        if len(self.points) < 1:
+            return None
+        if func == "count":
+            return len(self.points)
+        elif func == "sum":
+            return self.total
+        elif func == "mean":
+            return self.total / len(self.points)
+        elif func == "min":
+            return self.mins[0][1]
+        elif func == "max":
+            return self.maxs[0][1]
+        elif func == "last":
+            return self.points[-1][1]
+        raise NotImplementedError()
+
+class RollingRate():
+    """ Per-window average rate of increase of the values in a sliding time window
+
+    As aggregate.rate of InfluxDB, the non-negative rate per unit is computed between
+    consecutive values and averaged within windows aligned to every. Timestamps are
+    in nanoseconds.
+    """
+    def __init__(self, every, unit):
+        self.every = every
+        self.unit = unit
+        self.previous = None
+        self.rates = deque()
+        # window start -> [sum of rates, number of rates]
+        self.windows = OrderedDict()
 
-# class RedixDataBackbone(DataBackbone):
-#     def __init__(self, redix_url):
-#         self.data = pd.DataFrame(measurements)
+    def add(self, timestamp, value):
+        if self.previous is not None and timestamp > self.previous[0]:
+            rate = (value - self.previous[1]) * self.unit / (timestamp - self.previous[0])
+            if rate >= 0:
+                start = timestamp - timestamp % self.every
+                self.rates.append((timestamp, rate, start))
+                window = self.windows.setdefault(start, [0., 0])
+                window[0] += rate
+                window[1] += 1
+        self.previous = (timestamp, value)
 
-#     def get_measurements(self, name, last=False, **meta) -> pd.DataFrame:
-#         return self.data
+    def evict(self, cutoff):
+        while len(self.rates) > 0 and self.rates[0][0] <= cutoff:
+            _, rate, start = self.rates.popleft()
+            window = self.windows[start]
+            window[0] -= rate
+            window[1] -= 1
+        while len(self.windows) > 0:
+            start = next(iter(self.windows))
+            if start + self.every > cutoff or self.windows[start][1] > 0:
+                break
+            self.windows.popitem(last=False)
+
+    def empty(self, cutoff):
+        return len(self.rates) < 1 and (self.previous is None or self.previous[0] <= cutoff)
+
+    def get(self, cutoff, now) -> pd.DataFrame:
+        starts = np.arange(cutoff - cutoff % self.every, now + 1, self.every, dtype=np.int64)
+        values = np.full(len(starts), np.nan)
+        for i, start in enumerate(starts):
+            window = self.windows.get(int(start))
+            if window is not None and window[1] > 0:
+                values[i] = window[0] / window[1]
+        return pd.DataFrame({
+            "timestamp": pd.to_datetime(np.minimum(starts + self.every, now), unit="ns", utc=True),
+            "value": values,
+        })
+
+class StreamingDataBackbone(DataBackbone):
+    """ Keeps aggregates and rates of measurements up to date incrementally
+
+    Each (name, meta, since) of get_aggregate and (name, meta, since, window, unit)
+    of get_rate keeps a rolling state per series, that is per set of tags. A repeated
+    request reads from source only the measurements since the latest one it has seen,
+    looking back overlap seconds further, and evicts the ones that left the window,
+    so that it costs O(new measurements). A measurement written later than a newer one
+    is picked up when the state is rebuilt after ttl.
+
+    An aggregate is reduced by backbone, which returns only the aggregate, unless it is
+    requested again within half of its window, as reading the new measurements would
+    otherwise cost as much as reading the window. Names with values that are not numbers
+    and other requests are passed to backbone.
+    """
+    def __init__(self, backbone: DataBackbone, source: DataBackbone = None, ttl=300, max_states=1024, overlap=0):
+        self.backbone = backbone
+        self.source = backbone if source is None else source
+        self.ttl = ttl
+        self.max_states = max_states
+        self.overlap = overlap
+        self.states = OrderedDict()
+        self.ingested = 0
+        self._lock = threading.Lock()
+
+    def _key(self, *args, **meta):
+        key = (args, tuple(sorted(meta.items())))
+        hash(key)
+        return key
+
+    def _entry(self, now) -> dict:
+        # fetched_at is None until the window is read
+        return {"series": {}, "watermarks": {}, "latest": None, "numeric": True, "created_at": now, "requested_at": now, "fetched_at": None}
+
+    # _update returns the state of each series of the key, or None if the request
+    # is to be passed to backbone. If incremental, the state is kept only while
+    # reading the new measurements costs less than reading half of the window.
+    def _update(self, key, name, since, meta, create, incremental=False):
+        now = time.time_ns()
+        span = get_timedelta(since)
+        half = span.total_seconds() * 1e9 / 2
+        with self._lock:
+            entry = self.states.get(key)
+            if entry is not None:
+                self.states.move_to_end(key)
+            if entry is None or now - entry["created_at"] > self.ttl * 1e9:
+                first = entry is None
+                entry = self._entry(now if entry is None else entry["requested_at"])
+                entry["created_at"] = now
+                self.states[key] = entry
+                while len(self.states) > self.max_states:
+                    self.states.popitem(last=False)
+                if incremental and first:
+                    return None, None, now
+            if not entry["numeric"]:
+                return None, None, now
+            requested_at, entry["requested_at"] = entry["requested_at"], now
+            request_since = since
+            if entry["fetched_at"] is not None:
+                read_from = entry["latest"] if entry["latest"] is not None else entry["fetched_at"]
+                if incremental and now - read_from > half:
+                    # the state is dropped and built again once requested more often
+                    self.states[key] = self._entry(now)
+                    return None, None, now
+                seconds = int(np.ceil((now - read_from) / 1e9 + self.overlap)) + 1
+                if seconds < span.total_seconds():
+                    request_since = f'-{seconds}s'
+            elif incremental and now - requested_at > half:
+                return None, None, now
+            entry["fetched_at"] = now
+        df = self.source.get_measurements(name, request_since, **meta)
+        if len(df) > 0:
+            try:
+                values = pd.to_numeric(df["value"]).to_numpy(dtype=float)
+            except (ValueError, TypeError):
+                with self._lock:
+                    entry["numeric"] = False
+                return None, None, now
+            timestamps = df["timestamp"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+            series = [tuple(sorted(m.items())) for m in get_meta(df)]
+            order = np.argsort(timestamps, kind="stable").tolist()
+        else:
+            order = []
+        cutoff = now - span // datetime.timedelta(microseconds=1) * 1000
+        with self._lock:
+            states = entry["series"]
+            watermarks = entry["watermarks"]
+            for i in order:
+                timestamp = int(timestamps[i])
+                # measurements already seen or out of order within their series are skipped
+                watermark = watermarks.get(series[i])
+                if watermark is not None and timestamp <= watermark:
+                    continue
+                state = states.get(series[i])
+                if state is None:
+                    state = states[series[i]] = create()
+                state.add(timestamp, float(values[i]))
+                watermarks[series[i]] = timestamp
+                if entry["latest"] is None or timestamp > entry["latest"]:
+                    entry["latest"] = timestamp
+                self.ingested += 1
+            for s in list(states.keys()):
+                states[s].evict(cutoff)
+                if states[s].empty(cutoff):
+                    del states[s]
+                    del watermarks[s]
+        return states, cutoff, now
+
+    def get_measurements(self, name, since="-1m", last=False, **meta) -> pd.DataFrame:
+        return self.backbone.get_measurements(name, since, last, **meta)
+
+    def get_aggregate(self, name, since, func, **meta):
+        if func not in ["count", "sum", "mean", "min", "max", "last"]:
+            raise NotImplementedError()
+        try:
+            key = self._key("aggregate", name, since, **meta)
+        except TypeError:
+            return self.backbone.get_aggregate(name, since, func, **meta)
+        states, _, _ = self._update(key, name, since, meta, RollingWindow, incremental=True)
+        if states is None:
+            return self.backbone.get_aggregate(name, since, func, **meta)
+        with self._lock:
+            return RollingWindow.merge(list(states.values()), func)
+
+    # get_rate returns the sum over the series of their mean rate in each window, as aggregate.rate does
+    def get_rate(self, name, since, window="1s", unit="1s", **meta) -> pd.DataFrame:
+        try:
+            key = self._key("rate", name, since, window, unit, **meta)
+        except TypeError:
+            return self.backbone.get_rate(name, since, window, unit, **meta)
+        every = get_timedelta(f'-{window}') // datetime.timedelta(microseconds=1) * 1000
+        per = get_timedelta(f'-{unit}') // datetime.timedelta(microseconds=1) * 1000
+        states, cutoff, now = self._update(key, name, since, meta, lambda: RollingRate(every, per))
+        if states is None:
+            return self.backbone.get_rate(name, since, window, unit, **meta)
+        with self._lock:
+            frames = [state.get(cutoff, now) for state in states.values()]
+        if len(frames) < 1:
+            return pd.DataFrame({"timestamp": pd.Series(dtype="datetime64[ns, UTC]"), "value": pd.Series(dtype=float)})
+        # the windows of every series start at the same times
+        values = np.vstack([df["value"].to_numpy() for df in frames])
+        seen = ~np.isnan(values)
+        total = np.where(seen, values, 0.).sum(axis=0)
+        total[~seen.any(axis=0)] = np.nan
+        return pd.DataFrame({"timestamp": frames[0]["timestamp"], "value": total})
+
+class RedisDataBackbone(CachingDataBackbone):
+    """ Caches windows of measurements in Redis in front of another backbone
+
+    Windows are kept as CachingDataBackbone keeps them, but in Redis so that
+    checkers on the same node share them. The measurements of a window are in
+    a sorted set scored by timestamp and keyed by name and tags; windows of the
+    last measurement per series, such as last executions of plugins, are in a
+    hash keyed by series. Keys expire after the TTL, when the window is fetched
+    fully again. client is a redis.Redis or compatible client.
+    """
+    def __init__(self, backbone: DataBackbone, client, ttl=60, ttls=None, min_interval=0, prefix="sciencerule"):
+        super().__init__(backbone, ttl=ttl, ttls=ttls, min_interval=min_interval)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, name, meta, last) -> str:
+        return f'{self.prefix}:{"last" if last else "window"}:{name}:{json.dumps(dict(meta), sort_keys=True, default=str)}'
+
+    # _encode returns the rows of df as (timestamp in ns, series, member)
+    def _encode(self, df: pd.DataFrame) -> list:
+        if len(df) < 1:
+            return []
+        timestamps = pd.DatetimeIndex(df["timestamp"]).as_unit("ns").asi8
+        values = df["value"].tolist()
+        rows = []
+        for t, v, m in zip(timestamps, values, get_meta(df)):
+            series = json.dumps(m, sort_keys=True, default=str)
+            rows.append((int(t), series, json.dumps([int(t), v, m], sort_keys=True, default=str)))
+        return rows
+
+    def _decode(self, name, members) -> pd.DataFrame:
+        rows = [json.loads(m) for m in members]
+        rows.sort(key=lambda r: r[0])
+        return pd.DataFrame({
+            "timestamp": pd.to_datetime([r[0] for r in rows], unit="ns", utc=True),
+            "name": name,
+            "value": [r[1] for r in rows],
+            "meta": [r[2] for r in rows],
+        }, columns=RECORD_COLUMNS)
+
+    def _write(self, pipeline, key, df: pd.DataFrame, last):
+        rows = self._encode(df)
+        if len(rows) < 1:
+            return
+        if last:
+            pipeline.hset(key, mapping={series: m for _, series, m in rows})
+        else:
+            # scores are in microseconds as doubles can not hold nanoseconds since the epoch exactly
+            pipeline.zadd(key, {m: t / 1000 for t, _, m in rows})
+
+    def _read(self, key, name, last, cutoff) -> pd.DataFrame:
+        if last:
+            df = self._decode(name, self.client.hvals(key))
+            return df[df["timestamp"] > pd.Timestamp(cutoff, unit="s", tz="UTC")]
+        return self._decode(name, self.client.zrangebyscore(key, f'({cutoff * 1e6}', "+inf"))
+
+    def _info(self, key) -> dict:
+        return {k.decode() if isinstance(k, bytes) else k: float(v) for k, v in self.client.hgetall(f'{key}:info').items()}
+
+    def _fresh(self, key, name, since) -> bool:
+        now = time.time()
+        info = self._info(key)
+        return len(info) > 0 and now - info["created_at"] <= self.ttls.get(name, self.ttl) and \
+            get_timedelta(since).total_seconds() <= info["span"] and now - info["fetched_at"] < self.min_interval
+
+    def _fetch(self, key, name, since, last, meta) -> pd.DataFrame:
+        span = get_timedelta(since)
+        now = time.time()
+        info_key = f'{key}:info'
+        info = self._info(key)
+        ttl = self.ttls.get(name, self.ttl)
+        stale = len(info) < 1 or now - info["created_at"] > ttl or span.total_seconds() > info["span"]
+        if not stale and now - info["fetched_at"] < self.min_interval:
+            with self._lock:
+                self.hits += 1
+            return self._read(key, name, last, now - info["span"])
+        if stale:
+            df = self.backbone.get_measurements(name, since, last, **meta)
+            pipeline = self.client.pipeline()
+            pipeline.delete(key)
+            if last:
+                df = self._last_per_series(df) if len(df) > 0 else df
+            self._write(pipeline, key, df, last)
+            watermark = int(pd.DatetimeIndex(df["timestamp"]).as_unit("ns").asi8.max()) if len(df) > 0 else -1
+            pipeline.hset(info_key, mapping={"created_at": now, "fetched_at": now, "span": span.total_seconds(), "watermark": watermark})
+            pipeline.expire(key, int(np.ceil(ttl)))
+            pipeline.expire(info_key, int(np.ceil(ttl)))
+            pipeline.execute()
+            with self._lock:
+                self.misses += 1
+            return df
+        # fetch the measurements since the last one any checker has seen
+        watermark = int(info["watermark"])
+        seconds = now - (watermark / 1e9 if watermark >= 0 else info["fetched_at"])
+        delta = self.backbone.get_measurements(name, self._since(seconds), last, **meta)
+        if len(delta) > 0:
+            timestamps = pd.DatetimeIndex(delta["timestamp"]).as_unit("ns").asi8
+            delta = delta[timestamps > watermark]
+        pipeline = self.client.pipeline()
+        if len(delta) > 0:
+            if last:
+                delta = self._last_per_series(delta)
+            self._write(pipeline, key, delta, last)
+            watermark = max(watermark, int(pd.DatetimeIndex(delta["timestamp"]).as_unit("ns").asi8.max()))
+        if not last:
+            pipeline.zremrangebyscore(key, "-inf", (now - info["span"]) * 1e6)
+        pipeline.hset(info_key, mapping={"fetched_at": now, "watermark": watermark})
+        # key does not exist yet if the full fetch returned nothing; it expires with the window
+        pipeline.expire(key, max(1, int(np.ceil(info["created_at"] + ttl - now))))
+        pipeline.execute()
+        with self._lock:
+            self.deltas += 1
+        return self._read(key, name, last, now - info["span"])
+
+    def clear(self):
+        for key in self.client.scan_iter(match=f'{self.prefix}:*'):
+            self.client.delete(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "deltas": self.deltas,
+                "misses": self.misses,
+            }
+
+class QueryPlanner(ast.NodeTransformer):
+    """ Rewrites reductions over v() into backbone aggregations
+
+    A call like avg(v('env.temperature', since='-5m', sensor='bme680')) becomes
+    _aggregate('mean', 'env.temperature', since='-5m', sensor='bme680') so that
+    the backbone returns only the reduced value instead of all measurements.
+    Only calls whose arguments are all literals are rewritten.
+    """
+    aggregates = {
+        "avg": "mean",
+        "max": "max",
+        "min": "min",
+        "len": "count",
+        "sum": "sum",
+        "last": "last",
+    }
+
+    def _is_literal(self, node):
+        return isinstance(node, ast.Constant)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.func, ast.Name) or node.func.id not in self.aggregates:
+            return node
+        if len(node.args) != 1 or len(node.keywords) > 0:
+            return node
+        inner = node.args[0]
+        if not isinstance(inner, ast.Call) or not isinstance(inner.func, ast.Name) or inner.func.id != "v":
+            return node
+        if len(inner.args) != 1 or not self._is_literal(inner.args[0]):
+            return node
+        for k in inner.keywords:
+            # last=True already reduces the query and **meta can not be planned
+            if k.arg in [None, "last"] or not self._is_literal(k.value):
+                return node
+        planned = ast.Call(
+            func=ast.Name(id="_aggregate", ctx=ast.Load()),
+            args=[ast.Constant(value=self.aggregates[node.func.id])] + inner.args,
+            keywords=inner.keywords)
+        # internal functions can only be called by nodes of the planner
+        planned.planned = True
+        return ast.copy_location(planned, node)
+
+class CallCollector(ast.NodeVisitor):
+    """ Collects calls of the functions that query the backbone
+
+    Only calls whose arguments are all literals are collected, as (function, args, kwargs).
+    A rule is dynamic if its result may change without new measurements, that is
+    when it reads the clock or queries the backbone with computed arguments.
+    """
+    functions = ["v", "_aggregate", "rate", "after", "cronjob"]
+    clock_functions = ["time", "cronjob"]
+
+    def __init__(self):
+        self.calls = []
+        self.dynamic = False
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.func, ast.Name):
+            return
+        if node.func.id in self.clock_functions:
+            self.dynamic = True
+        if node.func.id not in self.functions:
+            return
+        if not all(isinstance(a, ast.Constant) for a in node.args) or \
+                not all(k.arg is not None and isinstance(k.value, ast.Constant) for k in node.keywords):
+            self.dynamic = True
+            return
+        # after() compares against the current time when since is a number of seconds
+        if node.func.id == "after" and any(isinstance(k.value.value, int) for k in node.keywords if k.arg == "since"):
+            self.dynamic = True
+        if node.func.id == "after" and len(node.args) > 1 and isinstance(node.args[1].value, int):
+            self.dynamic = True
+        self.calls.append((node.func.id, tuple(a.value for a in node.args), {k.arg: k.value.value for k in node.keywords}))
+
+class RuleEngine():
+    """ Compiles a rule into a tree of closures over a restricted grammar
+
+    Rules may only contain literals, comparisons, boolean and arithmetic operators,
+    subscripts, conditional expressions and calls of the supported functions and
+    the builtins below. Anything else, such as attribute access, lambdas or
+    comprehensions, is rejected with a SyntaxError when the rule is compiled.
+    Subexpressions that do not call a supported function are folded into constants,
+    and and/or stop evaluating, and hence querying the backbone, once the result is known.
+    Operators that could take long or exhaust memory, such as 10**999**999 or 'a' * 10**9,
+    refuse operands whose result would exceed max_bits or max_length, when folded as well
+    as when evaluated. Functions starting with an underscore are only called by the planner.
+    """
+    # largest integer in bits and longest sequence, counting nested items, an operator may return
+    max_bits = 4096
+    max_length = 100000
+
+    builtins = {
+        "abs": abs,
+        "all": all,
+        "any": any,
+        "bool": bool,
+        "float": float,
+        "int": int,
+        "len": len,
+        "max": max,
+        "min": min,
+        "round": round,
+        "str": str,
+    }
+
+    binary_operators = {
+        ast.Sub: operator.sub,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+    }
+
+    unary_operators = {
+        ast.Not: operator.not_,
+        ast.USub: operator.neg,
+        ast.UAdd: operator.pos,
+    }
+
+    comparisons = {
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+        ast.In: lambda a, b: a in b,
+        ast.NotIn: lambda a, b: a not in b,
+        ast.Is: operator.is_,
+        ast.IsNot: operator.is_not,
+    }
+
+    # _size returns the number of items of a sequence and of the sequences in it,
+    # counting no further than just over max_length, or None if value is not a sequence
+    @classmethod
+    def _size(cls, value):
+        if not isinstance(value, (str, bytes, list, tuple)):
+            return None
+        size = 0
+        stack = [value]
+        while len(stack) > 0 and size <= cls.max_length:
+            v = stack.pop()
+            if isinstance(v, (str, bytes)):
+                size += len(v)
+            elif isinstance(v, (list, tuple)):
+                size += len(v)
+                stack.extend(v)
+        return size
+
+    @classmethod
+    def _check_bits(cls, bits):
+        if bits > cls.max_bits:
+            raise Exception(f'result of more than {cls.max_bits} bits is too large')
+
+    @classmethod
+    def _check_length(cls, length):
+        if length > cls.max_length:
+            raise Exception(f'result of more than {cls.max_length} items is too long')
+
+    @classmethod
+    def add(cls, a, b):
+        size_a, size_b = cls._size(a), cls._size(b)
+        if size_a is not None and size_b is not None:
+            cls._check_length(size_a + size_b)
+        return a + b
+
+    @classmethod
+    def multiply(cls, a, b):
+        for sequence, n in [(a, b), (b, a)]:
+            size = cls._size(sequence)
+            if size is None:
+                continue
+            try:
+                cls._check_length(size * operator.index(n))
+            except TypeError:
+                pass
+        if type(a) is int and type(b) is int:
+            cls._check_bits(a.bit_length() + b.bit_length())
+        return a * b
+
+    # power returns the power of a and b, refusing exponents that would take long to compute
+    @classmethod
+    def power(cls, a, b):
+        if isinstance(b, int) and abs(b) > 1000:
+            raise Exception(f'exponent {b} is too large')
+        if type(a) is int and type(b) is int and b > 0:
+            cls._check_bits(a.bit_length() * b)
+        return a ** b
+
+    # modulo refuses formatting strings, as '%0999999999d' % 0 would exhaust memory
+    @staticmethod
+    def modulo(a, b):
+        if isinstance(a, (str, bytes)):
+            raise Exception('formatting strings is not supported in rules')
+        return a % b
+
+    # total is sum that concatenates sequences with add
+    @classmethod
+    def total(cls, values, start=0):
+        if cls._size(start) is None:
+            return sum(values, start)
+        return functools.reduce(cls.add, values, start)
+
+    def __init__(self, functions=()):
+        self.functions = set(functions)
+        self.builtins = {**self.builtins, "sum": self.total}
+        self.binary_operators = {
+            **self.binary_operators,
+            ast.Add: self.add,
+            ast.Mult: self.multiply,
+            ast.Mod: self.modulo,
+            ast.Pow: self.power,
+        }
+
+    def compile(self, tree: ast.Expression):
+        """ Returns a function that evaluates the rule with the given supported functions """
+        run, _ = self._compile(tree.body)
+        return run
+
+    # each node compiles to (run, constant) where constant is a tuple holding the value
+    # of a node that does not depend on the supported functions, or None
+    def _constant(self, value):
+        return (lambda funcs: value), (value,)
+
+    def _fold(self, run, operands):
+        if not all(constant is not None for _, constant in operands):
+            return run, None
+        try:
+            return self._constant(run(None))
+        except Exception:
+            # the error is reported when the rule is evaluated
+            return run, None
+
+    def _compile(self, node):
+        handler = getattr(self, f'_compile_{type(node).__name__}', None)
+        if handler is None:
+            raise SyntaxError(f'{type(node).__name__} is not supported in rules')
+        return handler(node)
+
+    def _compile_Constant(self, node):
+        return self._constant(node.value)
+
+    def _compile_Name(self, node):
+        if node.id in self.functions or node.id in self.builtins:
+            raise SyntaxError(f'function {node.id} must be called')
+        raise SyntaxError(f"name '{node.id}' is not defined")
+
+    def _compile_List(self, node):
+        items = [self._compile(e) for e in node.elts]
+        runs = [run for run, _ in items]
+        return self._fold(lambda funcs: [run(funcs) for run in runs], items)
+
+    def _compile_Tuple(self, node):
+        items = [self._compile(e) for e in node.elts]
+        runs = [run for run, _ in items]
+        return self._fold(lambda funcs: tuple(run(funcs) for run in runs), items)
+
+    def _compile_Set(self, node):
+        items = [self._compile(e) for e in node.elts]
+        runs = [run for run, _ in items]
+        return self._fold(lambda funcs: {run(funcs) for run in runs}, items)
+
+    def _compile_BoolOp(self, node):
+        is_and = isinstance(node.op, ast.And)
+        operands = []
+        for i, value in enumerate(node.values):
+            run, constant = self._compile(value)
+            if constant is not None and i < len(node.values) - 1:
+                try:
+                    decides = not constant[0] if is_and else bool(constant[0])
+                except Exception:
+                    decides = None
+                if decides is True:
+                    # the remaining operands are never evaluated
+                    operands.append((run, constant))
+                    break
+                if decides is False:
+                    continue
+            operands.append((run, constant))
+        if len(operands) == 1:
+            return operands[0]
+        runs = [run for run, _ in operands]
+        last = runs[-1]
+        if is_and:
+            def run(funcs):
+                for r in runs[:-1]:
+                    value = r(funcs)
+                    if not value:
+                        return value
+                return last(funcs)
+        else:
+            def run(funcs):
+                for r in runs[:-1]:
+                    value = r(funcs)
+                    if value:
+                        return value
+                return last(funcs)
+        return self._fold(run, operands)
+
+    def _compile_BinOp(self, node):
+        if type(node.op) in self.binary_operators:
+            op = self.binary_operators[type(node.op)]
+        else:
+            raise SyntaxError(f'operator {type(node.op).__name__} is not supported in rules')
+        left, right = self._compile(node.left), self._compile(node.right)
+        l, r = left[0], right[0]
+        return self._fold(lambda funcs: op(l(funcs), r(funcs)), [left, right])
+
+    def _compile_UnaryOp(self, node):
+        if type(node.op) not in self.unary_operators:
+            raise SyntaxError(f'operator {type(node.op).__name__} is not supported in rules')
+        op = self.unary_operators[type(node.op)]
+        operand = self._compile(node.operand)
+        o = operand[0]
+        return self._fold(lambda funcs: op(o(funcs)), [operand])
+
+    def _compile_Compare(self, node):
+        for op in node.ops:
+            if type(op) not in self.comparisons:
+                raise SyntaxError(f'comparison {type(op).__name__} is not supported in rules')
+        ops = [self.comparisons[type(op)] for op in node.ops]
+        operands = [self._compile(node.left)] + [self._compile(c) for c in node.comparators]
+        runs = [run for run, _ in operands]
+        if len(ops) == 1:
+            op, l, r = ops[0], runs[0], runs[1]
+            return self._fold(lambda funcs: op(l(funcs), r(funcs)), operands)
+        def run(funcs):
+            left = runs[0](funcs)
+            for op, r in zip(ops, runs[1:]):
+                right = r(funcs)
+                result = op(left, right)
+                if not result:
+                    return result
+                left = right
+            return result
+        return self._fold(run, operands)
+
+    def _compile_Call(self, node):
+        if not isinstance(node.func, ast.Name):
+            raise SyntaxError('only functions can be called in rules')
+        name = node.func.id
+        if name not in self.functions and name not in self.builtins:
+            raise SyntaxError(f'function {name} is not supported')
+        if name.startswith("_") and not getattr(node, "planned", False):
+            raise SyntaxError(f'function {name} is not supported')
+        if any(isinstance(a, ast.Starred) for a in node.args) or any(k.arg is None for k in node.keywords):
+            raise SyntaxError(f'unpacking arguments of {name} is not supported in rules')
+        args = [self._compile(a) for a in node.args]
+        kwargs = [(k.arg, self._compile(k.value)) for k in node.keywords]
+        arg_runs = [run for run, _ in args]
+        kwarg_runs = [(k, run) for k, (run, _) in kwargs]
+        if name in self.functions:
+            def run(funcs):
+                return funcs[name](*[r(funcs) for r in arg_runs], **{k: r(funcs) for k, r in kwarg_runs})
+            return run, None
+        func = self.builtins[name]
+        def run(funcs):
+            return func(*[r(funcs) for r in arg_runs], **{k: r(funcs) for k, r in kwarg_runs})
+        return self._fold(run, args + [c for _, c in kwargs])
+
+    def _compile_Subscript(self, node):
+        value = self._compile(node.value)
+        index = node.slice
+        # Python before 3.9 wraps the index in ast.Index
+        if type(index).__name__ == "Index":
+            index = index.value
+        index = self._compile(index)
+        v, i = value[0], index[0]
+        return self._fold(lambda funcs: v(funcs)[i(funcs)], [value, index])
+
+    def _compile_Slice(self, node):
+        parts = [self._compile(p) if p is not None else self._constant(None) for p in [node.lower, node.upper, node.step]]
+        lower, upper, step = [run for run, _ in parts]
+        return self._fold(lambda funcs: slice(lower(funcs), upper(funcs), step(funcs)), parts)
+
+    def _compile_IfExp(self, node):
+        test, body, orelse = self._compile(node.test), self._compile(node.body), self._compile(node.orelse)
+        if test[1] is not None:
+            try:
+                return body if test[1][0] else orelse
+            except Exception:
+                pass
+        t, b, o = test[0], body[0], orelse[0]
+        return (lambda funcs: b(funcs) if t(funcs) else o(funcs)), None
+
+class CompiledRule():
+    """ A rule compiled for evaluation with the backbone calls it makes """
+    def __init__(self, rule, run, calls, dynamic=False):
+        self.rule = rule
+        self.run = run
+        self.calls = calls
+        self.dynamic = dynamic
+
+class RuleCache():
+    """ Keeps compiled rules keyed by their rule text
+
+    Rules are parsed and compiled once and reused across evaluations.
+    The least recently used rule is dropped when the cache is full.
+    """
+    def __init__(self, maxsize=256, functions=()):
+        self.maxsize = maxsize
+        self.engine = RuleEngine(functions)
+        self.hits = 0
+        self.misses = 0
+        self._rules = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _compile(self, rule) -> CompiledRule:
+        tree = ast.parse(rule.strip(), mode="eval")
+        tree = ast.fix_missing_locations(QueryPlanner().visit(tree))
+        collector = CallCollector()
+        collector.visit(tree)
+        return CompiledRule(rule, self.engine.compile(tree), collector.calls, collector.dynamic)
+
+    def get(self, rule) -> CompiledRule:
+        with self._lock:
+            compiled = self._rules.get(rule)
+            if compiled is not None:
+                self._rules.move_to_end(rule)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        # compile outside of the lock; a SyntaxError is not cached
+        compiled = self._compile(rule)
+        with self._lock:
+            self._rules[rule] = compiled
+            self._rules.move_to_end(rule)
+            while len(self._rules) > self.maxsize:
+                self._rules.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._rules.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._rules),
+                "maxsize": self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._rules)
+
+class SchedulerState():
+    """ Index of the last execution time of plugins
+
+    The last execution of a plugin is read from the backbone when the plugin is
+    first looked up. Afterwards the index is updated from the executions recorded
+    since the previous update, at most every refresh_interval seconds.
+    """
+    def __init__(self, lookback="-30d", refresh_interval=1, overlap=60):
+        self.lookback = lookback
+        self.refresh_interval = refresh_interval
+        # executions may be written late; updates look back overlap seconds further
+        self.overlap = overlap
+        self.last_executions = {}
+        self.loaded = set()
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    def _update(self, df: pd.DataFrame):
+        if len(df) < 1:
+            return
+        for plugin, timestamp in df.groupby("value")["timestamp"].max().items():
+            self.loaded.add(plugin)
+            if plugin not in self.last_executions or self.last_executions[plugin] < timestamp:
+                self.last_executions[plugin] = timestamp
+
+    def refresh(self, backbone: DataBackbone):
+        now = time.time()
+        with self._lock:
+            if self.refreshed_at is None:
+                self.refreshed_at = now
+                return
+            if now - self.refreshed_at < self.refresh_interval:
+                return
+            since = f'-{int(np.ceil(now - self.refreshed_at)) + self.overlap}s'
+        with stage("query"):
+            df = backbone.get_measurements(LAST_EXECUTION, since=since)
+        with self._lock:
+            self._update(df)
+            self.refreshed_at = max(self.refreshed_at, now)
+
+    def last_execution(self, plugin, backbone: DataBackbone):
+        """ Returns the last execution time of the plugin or None if it has not run """
+        self.refresh(backbone)
+        with self._lock:
+            if plugin in self.loaded:
+                return self.last_executions.get(plugin)
+        with stage("query"):
+            df = backbone.get_measurements(LAST_EXECUTION, since=self.lookback, last=True, _value=plugin)
+        with self._lock:
+            self._update(df)
+            self.loaded.add(plugin)
+            return self.last_executions.get(plugin)
+
+class CronSchedule():
+    """ Previous and next fire times of cron expressions
+
+    The fire times are advanced as time passes, so that a croniter is
+    created only when the next fire time is reached. When more than one
+    fire time has passed, or the clock was set back, they are computed from now.
+    """
+    def __init__(self):
+        self.fire_times = {}
+        self._lock = threading.Lock()
+
+    def get_prev(self, expr, now: datetime.datetime) -> datetime.datetime:
+        from croniter import croniter
+        with self._lock:
+            fire_times = self.fire_times.get(expr)
+            if fire_times is not None and now >= fire_times[1]:
+                following = croniter(expr, fire_times[1]).get_next(datetime.datetime)
+                fire_times = [fire_times[1], following] if now < following else None
+            if fire_times is None or now < fire_times[0]:
+                if not croniter.is_valid(expr):
+                    raise Exception(f'pattern {expr} is not supported')
+                fire_times = [croniter(expr, now).get_prev(datetime.datetime), croniter(expr, now).get_next(datetime.datetime)]
+            self.fire_times[expr] = fire_times
+            return fire_times[0]
 
 class Checker():
-    def __init__(self, backbone):
+    def __init__(self, backbone, rule_cache_size=256, scheduler_refresh_interval=1):
         self.backbone = backbone
+        self.funcs = self.get_dispatch()
+        self.rule_cache = RuleCache(rule_cache_size, functions=self.funcs.keys())
+        self.scheduler = SchedulerState(refresh_interval=scheduler_refresh_interval)
+        self.cron_schedule = CronSchedule()
     
     def get_supported_funcs(self):
         return {
@@ -171,8 +1905,35 @@ class Checker():
             "cronjob": self.cronjob,
             "after": self.after,
             "rate": self.rate,
+            "last": self.last,
         }
 
+    # get_dispatch returns the functions callable from compiled rules, including those the planner adds
+    def get_dispatch(self):
+        funcs = self.get_supported_funcs()
+        funcs["_aggregate"] = self.aggregate
+        return funcs
+
+    def with_backbone(self, backbone):
+        """ Returns a copy of the checker that queries the given backbone
+
+        The copy shares the rule cache and scheduler state with this checker.
+        """
+        checker = copy.copy(self)
+        checker.backbone = backbone
+        checker.funcs = checker.get_dispatch()
+        return checker
+
+    # reductions used when the backbone does not support get_aggregate
+    aggregates = {
+        "mean": lambda array: np.average(array),
+        "max": lambda array: reduce_values(array, "max"),
+        "min": lambda array: reduce_values(array, "min"),
+        "count": len,
+        "sum": lambda array: np.sum(array),
+        "last": lambda array: array[-1],
+    }
+
     def time(self, unit):
         try:
             return datetime.datetime.now(datetime.timezone.utc).__getattribute__(unit)
@@ -184,57 +1945,76 @@ class Checker():
     # if no execution found, it returns False
     def after(self, name, since=None):
         now = datetime.datetime.now(datetime.timezone.utc)
-        df = self.backbone.get_measurements("sys.scheduler.plugin.lastexecution", last=True, _value=name)
+        p1 = self.scheduler.last_execution(name, self.backbone)
         # return False if plugin has not run
-        if len(df) < 1:
+        if p1 is None:
             return False
-        p1 = df.iloc[0]
         if since == None:
-            return now > p1.timestamp
+            return now > p1
         # if another plugin is given, compare them
         elif isinstance(since, str):
-            df2 = self.backbone.get_measurements("sys.scheduler.plugin.lastexecution", last=True, _value=since)
+            p2 = self.scheduler.last_execution(since, self.backbone)
             # the other plugin has not run.
             # we can assume the plugin has run since the other plugin that never ran. Return True
-            if len(df2) < 1:
+            if p2 is None:
                 return True
-            p2 = df2.iloc[0]
-            return p1.timestamp > p2.timestamp
+            return p1 > p2
         # if since is a number, use it to compare with the plugin
         elif isinstance(since, int):
-            return (now - datetime.timedelta(seconds=since)) > p1.timestamp
+            return (now - datetime.timedelta(seconds=since)) > p1
         else:
             return Exception("since parameter must be a plugin name or positive integer")
 
     def avg(self, array):
         return np.average(array)
 
+    def last(self, array):
+        return array[-1]
+
+    # aggregate is what a reduction over v() becomes after query planning
+    def aggregate(self, func, name, **kargs):
+        since = kargs.pop("since", "-1m")
+        try:
+            with stage("query"):
+                value = self.backbone.get_aggregate(name, since, func, **kargs)
+        except NotImplementedError:
+            return self.aggregates[func](self.get_measurements(name, since=since, **kargs))
+        except Exception:
+            # a backbone may only reduce numbers, while max and min of the measurements
+            # compare any values, such as the plugin names of sys.scheduler.plugin.lastexecution
+            if func not in ["max", "min"]:
+                raise
+            return self.aggregates[func](self.get_measurements(name, since=since, **kargs))
+        if value is None:
+            raise Exception(f'no data for {name} with meta {kargs} found')
+        return value
+
     def cronjob(self, name, expr):
         # Accepting the cronjob pattern (minute hour day month year)
         # for example cronjob("imagesampler", "30 * * * *")
-        if not croniter.is_valid(expr):
-            raise Exception(f'pattern {expr} is not supported')
         now = datetime.datetime.now(datetime.timezone.utc)
-        cron_time = croniter(expr).get_prev(datetime.datetime).replace(tzinfo=datetime.timezone.utc)
+        cron_time = self.cron_schedule.get_prev(expr, now)
         # if no plugin specified, we return the croniter result
         if name == None or name == "":
             return now - cron_time < datetime.timedelta(minutes=1)
         if now - cron_time < datetime.timedelta(minutes=1):
             # we should check if we have already run the plugin for this cronjob period
-            df = self.backbone.get_measurements("sys.scheduler.plugin.lastexecution", last=True, _value=name)
-            for _, p in df.iterrows():
-                return now - p.timestamp > datetime.timedelta(minutes=1)
-            return True
+            last_execution = self.scheduler.last_execution(name, self.backbone)
+            if last_execution is None:
+                return True
+            return now - last_execution > datetime.timedelta(minutes=1)
         else:
             return False
-    
+
     def rate(self, name, **kargs):
         since = kargs.pop("since", "-1m")
         window = kargs.pop("window", "1s")
         unit = kargs.pop("unit", "1s")
-        df = self.backbone.get_rate(name, since, window, unit, **kargs)
+        with stage("query"):
+            df = self.backbone.get_rate(name, since, window, unit, **kargs)
         # returned DataFrame only contains timestamp and value, no meta fields
-        data = np.array([m["value"] for _, m in df.iterrows()])
+        with stage("conversion"):
+            data = self._values(df["value"].to_numpy()) if len(df) > 0 else np.array([])
         if len(data) < 1:
             raise Exception(f'no data for {name} with meta {kargs} found')
         else:
@@ -243,23 +2023,285 @@ class Checker():
     def get_measurements(self, name, **kargs):
         since = kargs.pop("since", "-1m")
         last = kargs.pop("last", False)
-        df = self.backbone.get_measurements(name, since, last, **kargs)
-        data = np.array([m["value"] for _, m in df.iterrows() if m["name"] == name and self.matchmeta(kargs, m["meta"])])
+        with stage("query"):
+            df = self.backbone.get_measurements(name, since, last, **kargs)
+        with stage("conversion"):
+            data = self._values(df["value"].to_numpy()[self.match(df, name, kargs)]) if len(df) > 0 else np.array([])
         if len(data) < 1:
             raise Exception(f'no data for {name} with meta {kargs} found')
         else:
             return data
 
+    def _values(self, values: np.ndarray) -> np.ndarray:
+        # let numpy infer the dtype of object columns, e.g. floats or strings
+        if values.dtype == object:
+            return np.array(values.tolist())
+        return values
+
+    def match(self, df: pd.DataFrame, name, pattern: dict) -> np.ndarray:
+        """ Returns a boolean mask of the rows having the name and meta in pattern
+
+        Tags are compared column-wise; a tag that is not a column of the DataFrame
+        is looked up from the expanded meta column.
+        """
+        mask = (df["name"] == name).to_numpy()
+        tags = None
+        for k, v in pattern.items():
+            if k in df.columns and k not in RECORD_COLUMNS:
+                column = df[k]
+            else:
+                if tags is None:
+                    tags = pd.DataFrame(df["meta"].tolist(), index=df.index) if "meta" in df.columns else pd.DataFrame(index=df.index)
+                if k not in tags.columns:
+                    return np.zeros(len(df), dtype=bool)
+                column = tags[k]
+            mask = mask & (column == v).to_numpy()
+        return mask
+
     def matchmeta(self, pattern: dict, meta):
         return all(k in meta and meta[k] == v for k, v in pattern.items())
 
-    def evaluate(self, rule) -> Tuple[bool, any]:
-        l = self.get_supported_funcs()
+    def get_requests(self, calls: list) -> list:
+        """ Returns the backbone requests made by the given function calls
+
+        A request is (method, args, meta) as the supported functions call the backbone.
+        after() and cronjob() are left out as they look up the scheduler state.
+        """
+        requests = []
+        for func, args, kargs in calls:
+            kargs = dict(kargs)
+            try:
+                if func == "v":
+                    name, = args
+                    since = kargs.pop("since", "-1m")
+                    last = kargs.pop("last", False)
+                    requests.append(("get_measurements", (name, since, last), kargs))
+                elif func == "_aggregate":
+                    f, name = args
+                    since = kargs.pop("since", "-1m")
+                    requests.append(("get_aggregate", (name, since, f), kargs))
+                elif func == "rate":
+                    name, = args
+                    since = kargs.pop("since", "-1m")
+                    window = kargs.pop("window", "1s")
+                    unit = kargs.pop("unit", "1s")
+                    requests.append(("get_rate", (name, since, window, unit), kargs))
+            except ValueError:
+                # the call will fail with the wrong arguments when evaluated
+                continue
+        return requests
+
+    def _counted(self, name, func, profile: Profile):
+        def call(*args, **kargs):
+            profile.count(name)
+            return func(*args, **kargs)
+        return call
+
+    def evaluate(self, rule, profile: Profile = None) -> Tuple[bool, any]:
+        l = self.funcs
+        token = current_profile.set(profile)
         try:
-            r = eval(rule, None, l)
-            if isinstance(r, bool) or isinstance(r, np.bool_):
+            if profile is not None:
+                # a reduction planned into the backbone stands for a call of v()
+                l = {k: self._counted("v" if k == "_aggregate" else k, f, profile) for k, f in l.items()}
+            with stage("compile"):
+                compiled = self.rule_cache.get(rule)
+            with stage("evaluation"):
+                r = compiled.run(l)
+            # numpy is not imported by rules that did not need it
+            if isinstance(r, bool) or ("numpy" in sys.modules and isinstance(r, np.bool_)):
                 return True, bool(r)
             else:
                 return False, f'rule produced not True/False: {str(r)}'
         except Exception as ex:
             return False, str(ex)
+        finally:
+            current_profile.reset(token)
+
+    def evaluate_many(self, rules: list, profile: Profile = None) -> list:
+        """ Evaluates rules together, sending each distinct backbone query once
+
+        Returns a list of (success, result) in the order of the given rules.
+        """
+        batch = self.with_backbone(BatchDataBackbone(self.backbone))
+        return [batch.evaluate(rule, profile) for rule in rules]
+
+
+class Subscription():
+    """ A rule whose result is pushed to clients when it changes
+
+    dependencies is the set of measurement names the rule reads, or None if the
+    rule is dynamic and is re-evaluated on every poll.
+    """
+    def __init__(self, rule, dependencies):
+        self.id = uuid.uuid4().hex
+        self.rule = rule
+        self.dependencies = dependencies
+        self.result = None
+        self.version = 0
+        self.evaluated_at = 0
+        self.touched_at = time.time()
+
+class RuleSubscriptions():
+    """ Re-evaluates subscribed rules only when measurements they depend on arrive
+
+    Each poll asks the backbone for the latest measurement of every name the
+    subscribed rules depend on, once per name, and re-evaluates the rules that
+    read a name with new measurements. Dynamic rules are re-evaluated on every poll,
+    and all rules at least every max_interval seconds as a result may also change
+    when measurements leave the window of a rule. Clients wait for a new version of
+    a subscription, which is only made when its result changes. Subscriptions no
+    client has waited on for idle_timeout seconds are dropped.
+    """
+    def __init__(self, checker: Checker, max_interval=60, idle_timeout=600, overlap=60):
+        self.checker = checker
+        self.max_interval = max_interval
+        self.idle_timeout = idle_timeout
+        # measurements may be written late; polls look back overlap seconds further
+        self.overlap = overlap
+        self.subscriptions = {}
+        # watermarks holds the latest timestamp seen of each name; None until the name has data
+        self.watermarks = {}
+        self.polled_at = None
+        self.evaluations = 0
+        self.notifications = 0
+        self._condition = threading.Condition()
+        self._poller = None
+
+    # get_dependencies returns the measurement names a compiled rule reads or None if it is dynamic
+    @staticmethod
+    def get_dependencies(compiled: CompiledRule):
+        if compiled.dynamic:
+            return None
+        names = set()
+        for func, args, _ in compiled.calls:
+            if func in ["v", "rate"] and len(args) > 0:
+                names.add(args[0])
+            elif func == "_aggregate":
+                names.add(args[1])
+            elif func in ["after", "cronjob"]:
+                names.add(LAST_EXECUTION)
+        return names
+
+    def subscribe(self, rule) -> Subscription:
+        """ Registers the rule and evaluates it for the first time
+
+        A SyntaxError is raised if the rule can not be compiled.
+        """
+        subscription = Subscription(rule, self.get_dependencies(self.checker.rule_cache.get(rule)))
+        self._evaluate(subscription)
+        with self._condition:
+            self.subscriptions[subscription.id] = subscription
+            for name in subscription.dependencies or []:
+                self.watermarks.setdefault(name, None)
+        return subscription
+
+    def unsubscribe(self, id) -> bool:
+        with self._condition:
+            subscription = self.subscriptions.pop(id, None)
+            self._condition.notify_all()
+        return subscription is not None
+
+    def get(self, id) -> Subscription:
+        with self._condition:
+            return self.subscriptions.get(id)
+
+    def wait(self, id, version=0, timeout=30) -> Subscription:
+        """ Waits up to timeout seconds for a version of the subscription newer than version
+
+        Returns the subscription, whose version is not newer on timeout, or None
+        if there is no such subscription.
+        """
+        with self._condition:
+            subscription = self.subscriptions.get(id)
+            if subscription is None:
+                return None
+            subscription.touched_at = time.time()
+            self._condition.wait_for(lambda: self.subscriptions.get(id) is not subscription or subscription.version > version, timeout)
+            subscription.touched_at = time.time()
+            return self.subscriptions.get(id)
+
+    def _evaluate(self, subscription: Subscription):
+        result = self.checker.evaluate(subscription.rule)
+        with self._condition:
+            self.evaluations += 1
+            subscription.evaluated_at = time.time()
+            if result != subscription.result:
+                subscription.result = result
+                subscription.version += 1
+                self.notifications += 1
+                self._condition.notify_all()
+
+    # _changed returns the names that have measurements newer than their watermark
+    def _changed(self, names, since) -> set:
+        changed = set()
+        for name in names:
+            try:
+                df = self.checker.backbone.get_measurements(name, since=since, last=True)
+            except Exception:
+                # the rules are evaluated to report the error
+                changed.add(name)
+                continue
+            if len(df) < 1:
+                continue
+            latest = df["timestamp"].max()
+            with self._condition:
+                watermark = self.watermarks.get(name)
+                if watermark is None or latest > watermark:
+                    self.watermarks[name] = latest
+                    changed.add(name)
+        return changed
+
+    def poll(self):
+        """ Re-evaluates the subscriptions whose result may have changed since the last poll """
+        now = time.time()
+        with self._condition:
+            for id, subscription in list(self.subscriptions.items()):
+                if now - subscription.touched_at > self.idle_timeout:
+                    del self.subscriptions[id]
+            subscriptions = list(self.subscriptions.values())
+            names = set()
+            for subscription in subscriptions:
+                names |= subscription.dependencies or set()
+            for name in list(self.watermarks):
+                if name not in names:
+                    del self.watermarks[name]
+            elapsed = 0 if self.polled_at is None else int(np.ceil(now - self.polled_at))
+            self.polled_at = now
+        changed = self._changed(names, f'-{elapsed + self.overlap}s')
+        for subscription in subscriptions:
+            if subscription.dependencies is None or \
+                    len(subscription.dependencies & changed) > 0 or \
+                    now - subscription.evaluated_at >= self.max_interval:
+                self._evaluate(subscription)
+
+    def start(self, interval=1):
+        """ Polls every interval seconds in a background thread """
+        def run(stop: threading.Event):
+            while not stop.wait(interval):
+                self.poll()
+        if self._poller is None:
+            stop = threading.Event()
+            thread = threading.Thread(target=run, args=(stop,), name="rule-subscriptions", daemon=True)
+            thread.start()
+            self._poller = stop
+
+    def stop(self):
+        if self._poller is not None:
+            self._poller.set()
+            self._poller = None
+
+    def close(self):
+        """ Stops polling and drops all subscriptions, ending the waits of clients """
+        self.stop()
+        with self._condition:
+            self.subscriptions.clear()
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "subscriptions": len(self.subscriptions),
+                "evaluations": self.evaluations,
+                "notifications": self.notifications,
+            }
@@ -0,0 +1,65 @@
+""" Serves the checker with preforked workers
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Each worker imports server.py after the fork, so the InfluxDB client, caches and
+background threads are set up once per worker and never shared across a fork.
+Metrics of all workers are aggregated in Prometheus multiprocess mode and
+served by the master on port 8000.
+"""
+import importlib
+import os
+import shutil
+import signal
+
+bind = f'0.0.0.0:{os.getenv("SERVER_PORT", 5000)}'
+# subscriptions live in the worker that made them, so only a single worker
+# serves them by id; more workers serve them as event streams only
+workers = int(os.getenv("SERVER_WORKERS", 1))
+# threads serve long polls and event streams of subscriptions while other requests are evaluated
+worker_class = "gthread"
+threads = int(os.getenv("SERVER_THREADS", 8))
+preload_app = False
+graceful_timeout = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/sciencerule-checker-metrics")
+
+
+def on_starting(arbiter):
+    # metrics of workers from a previous run must not be collected
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def when_ready(arbiter):
+    from prometheus_client import start_http_server, CollectorRegistry, multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(8000, registry=registry)
+
+
+def post_fork(arbiter, worker):
+    # server.py is imported after the fork and reads the number of workers, which -w may have changed
+    os.environ["SERVER_WORKERS"] = str(worker.cfg.workers)
+
+
+def post_worker_init(worker):
+    server = importlib.import_module("server")
+    server.start()
+    # end event streams and long polls on shutdown so that their requests
+    # finish within the graceful timeout
+    handle_exit = worker.handle_exit
+    def exit(sig, frame):
+        server.subscriptions.close()
+        handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, exit)
+
+
+def worker_exit(arbiter, worker):
+    importlib.import_module("server").shutdown()
+
+
+def child_exit(arbiter, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,294 @@
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import resource
+import threading
+import subprocess
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from checker import Checker, MemoryDataBackbone, InfluxDataBackbone, CachingDataBackbone, StreamingDataBackbone, LAST_EXECUTION, get_meta
+
+RULES = [
+    "avg(v('env.temperature', since='-5m', sensor='sensor0')) > 30",
+    "max(v('env.temperature', since='-1m')) > 40",
+    "any(v('env.relative_humidity', since='-1m') > 80)",
+    "len(v('env.count.car', since='-10m')) > 5",
+    "any(rate('env.raingauge.total_acc', since='-30m', window='5m', unit='1m') > 0.05)",
+    "cronjob('imagesampler', '*/5 * * * *')",
+    "after('motion-detector', since='imagesampler')",
+    "after('imagesampler', since=300)",
+    "time('hour') >= 0 and avg(v('env.temperature', since='-5m')) > 30",
+]
+
+PLUGINS = ["imagesampler", "motion-detector", "audiosampler"]
+
+
+def generate_measurements(rate, cardinality, duration):
+    """ Returns measurements of rate per second for each of cardinality sensors over the last duration seconds """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rng = np.random.default_rng(0)
+    measurements = []
+    n = int(duration * rate)
+    offsets = np.linspace(duration, 0, n, endpoint=False)
+    for sensor in [f'sensor{i}' for i in range(cardinality)]:
+        meta = {"sensor": sensor}
+        series = {
+            "env.temperature": rng.uniform(10, 40, n),
+            "env.relative_humidity": rng.uniform(20, 90, n),
+            "env.count.car": rng.integers(0, 3, n).astype(float),
+            "env.raingauge.total_acc": np.cumsum(rng.uniform(0, 0.01, n)),
+        }
+        for name, values in series.items():
+            for offset, value in zip(offsets, values):
+                measurements.append({"timestamp": now - datetime.timedelta(seconds=float(offset)), "name": name, "value": float(value), "meta": meta})
+    for i, plugin in enumerate(PLUGINS):
+        for offset in range(duration - i * 20, 0, -120):
+            measurements.append({"timestamp": now - datetime.timedelta(seconds=offset), "name": LAST_EXECUTION, "value": plugin, "meta": {}})
+    return measurements
+
+
+class StandInInfluxDB(ThreadingHTTPServer):
+    """ Answers the Flux queries built by InfluxDataBackbone from a MemoryDataBackbone """
+    reductions = {"mean()": "mean", "max()": "max", "min()": "min", "count()": "count", "sum()": "sum"}
+
+    def __init__(self, backbone: MemoryDataBackbone):
+        self.backbone = backbone
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(handler):
+                handler.send_response(204)
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+
+            def do_POST(handler):
+                body = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))))
+                annotations = body.get("dialect", {}).get("annotations", [])
+                data = self.answer(body["query"], len(annotations) > 0).encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/csv; charset=utf-8")
+                handler.send_header("Content-Length", str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data)
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def answer(self, query, annotated):
+        steps = query.split(" |> ")
+        since = re.search(r"range\(start: (\S+)\)", query).group(1)
+        filters = dict(re.findall(r'filter\(fn: \(r\) => r\["([^"]+)"\] == "([^"]*)"\)', query))
+        name = filters.pop("_measurement")
+        tail = steps[-1]
+        if tail in self.reductions:
+            return self.to_csv([self.backbone.get_aggregate(name, since, self.reductions[tail], **filters)], None, annotated)
+        rate = re.match(r"aggregate\.rate\(every: (\S+), unit: (\S+)\)", tail)
+        if rate is not None:
+            df = self.backbone.get_rate(name, since, rate.group(1), rate.group(2), **filters).dropna()
+            return self.to_csv(df["value"].tolist(), df["timestamp"].tolist(), annotated)
+        df = self.backbone.get_measurements(name, since, tail == "last()", **filters)
+        if len(df) < 1:
+            return "\r\n"
+        return self.to_csv(df["value"].tolist(), df["timestamp"].tolist(), annotated, name, get_meta(df))
+
+    def to_csv(self, values, timestamps, annotated, name=None, metas=None):
+        values = [v for v in values if v is not None]
+        if len(values) < 1:
+            return "\r\n"
+        tags = sorted({k for m in metas for k in m}) if metas is not None else []
+        columns = ["result", "table", "_value"]
+        types = ["string", "long", "string" if isinstance(values[0], str) else "double"]
+        if timestamps is not None:
+            columns.insert(2, "_time")
+            types.insert(2, "dateTime:RFC3339Nano")
+        if name is not None:
+            columns += ["_measurement"] + tags
+            types += ["string"] * (len(tags) + 1)
+        lines = []
+        if annotated:
+            lines += ["#datatype," + ",".join(types), "#group," + ",".join(["false"] * len(columns)), "#default," + ",".join([""] * len(columns))]
+        lines.append("," + ",".join(columns))
+        for i, value in enumerate(values):
+            row = ["_result", "0"]
+            if timestamps is not None:
+                row.append(timestamps[i].strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+            row.append(str(value))
+            if name is not None:
+                row += [name] + [str(metas[i].get(k, "")) for k in tags]
+            lines.append("," + ",".join(row))
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+
+# streaming reads new measurements directly from InfluxDB, as server.py does
+def streaming(influx):
+    return StreamingDataBackbone(CachingDataBackbone(influx), source=influx)
+
+
+def create_backbones(args, memory):
+    backbones = {"memory": lambda: memory}
+    if "influx" in args.backends or "cached" in args.backends or "streaming" in args.backends:
+        server = StandInInfluxDB(memory)
+        backbones["influx"] = lambda: InfluxDataBackbone(server.url, "token")
+        backbones["cached"] = lambda: CachingDataBackbone(InfluxDataBackbone(server.url, "token"))
+        backbones["streaming"] = lambda: streaming(InfluxDataBackbone(server.url, "token"))
+    return {name: backbones[name] for name in args.backends}
+
+
+# peak_rss_mb returns the peak resident memory of this process; ru_maxrss is
+# inherited from the parent across fork and exec on Linux, while VmHWM is not
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            return [int(line.split()[1]) for line in f if line.startswith("VmHWM:")][0] / 1024
+    except (OSError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(checker, rules, iterations):
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for rule in rules:
+            t = time.perf_counter()
+            ret, _ = checker.evaluate(rule)
+            latencies.append(time.perf_counter() - t)
+            if not ret:
+                errors += 1
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "rules_per_second": len(latencies) / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "errors": errors,
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for backend, result in results.items():
+        if backend not in baseline:
+            continue
+        base = baseline[backend]
+        for key in ["p50_ms", "p99_ms", "peak_rss_mb"]:
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{backend} {key} {result[key]:.2f} is worse than baseline {base[key]:.2f}')
+        if result["rules_per_second"] < base["rules_per_second"] * (1 - tolerance):
+            regressions.append(f'{backend} rules_per_second {result["rules_per_second"]:.1f} is worse than baseline {base["rules_per_second"]:.1f}')
+        # rules that fail are fast, so failures must not pass for speedups
+        if result["errors"] > base.get("errors", 0):
+            regressions.append(f'{backend} errors {result["errors"]} are more than baseline {base.get("errors", 0)}')
+    return regressions
+
+
+def run_backend(args, name):
+    memory = MemoryDataBackbone(generate_measurements(args.rate, args.cardinality, args.duration), max_points=10 ** 7)
+    checker = Checker(create_backbones(args, memory)[name]())
+    # the first evaluations compile rules and fill caches
+    run_benchmark(checker, RULES, 1)
+    return run_benchmark(checker, RULES, args.iterations)
+
+
+# measure runs the benchmark of a backend in a new process, so that its peak RSS is not of the backends before it
+def measure(args, name):
+    command = [
+        sys.executable, __file__, "--process",
+        "--backends", name,
+        "--rate", str(args.rate),
+        "--cardinality", str(args.cardinality),
+        "--duration", str(args.duration),
+        "--iterations", str(args.iterations),
+    ]
+    out = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+def run(args):
+    if args.process:
+        name, = args.backends
+        print(json.dumps(run_backend(args, name)))
+        return 0
+    results = {}
+    logging.info(f'{"backend":>10} {"p50 (ms)":>9} {"p99 (ms)":>9} {"rules/s":>9} {"rss (MB)":>9} {"errors":>7}')
+    for name in args.backends:
+        result = measure(args, name)
+        results[name] = result
+        logging.info(f'{name:>10} {result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} {result["rules_per_second"]:>9.1f} {result["peak_rss_mb"]:>9.1f} {result["errors"]:>7}')
+    if args.save_baseline != "":
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        logging.info(f'baseline saved to {args.save_baseline}')
+    if args.baseline != "":
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            logging.error(r)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks rule evaluation throughput and latency")
+    parser.add_argument("--backends",
+        dest="backends", nargs="+",
+        choices=["memory", "influx", "cached", "streaming"],
+        default=["memory", "influx", "cached", "streaming"],
+        help="backbones to benchmark")
+    parser.add_argument("--rate",
+        dest="rate", type=float,
+        default=1.,
+        help="measurements per second of each series")
+    parser.add_argument("--cardinality",
+        dest="cardinality", type=int,
+        default=4,
+        help="number of sensors of each measurement name")
+    parser.add_argument("--duration",
+        dest="duration", type=int,
+        default=1800,
+        help="seconds of measurements to generate")
+    parser.add_argument("--iterations",
+        dest="iterations", type=int,
+        default=20,
+        help="number of times each rule is evaluated")
+    parser.add_argument("--baseline",
+        dest="baseline", type=str,
+        default="",
+        help="fail if the results are worse than this baseline")
+    parser.add_argument("--save-baseline",
+        dest="save_baseline", type=str,
+        default="",
+        help="save the results as a baseline")
+    parser.add_argument("--tolerance",
+        dest="tolerance", type=float,
+        default=0.2,
+        help="allowed relative regression from the baseline")
+    parser.add_argument("--process",
+        dest="process", action="store_true",
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(levelname)s %(asctime)s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    exit(run(args))
@@ -0,0 +1,87 @@
+import sys
+import time
+import logging
+import argparse
+import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from checker import Checker, DataBackbone
+
+
+class StaticDataBackbone(DataBackbone):
+    def __init__(self, df):
+        self.df = df
+
+    def get_measurements(self, name, since="-1m", last=False, **meta):
+        return self.df
+
+    def get_rate(self, name, since, window="1s", unit="1s", **meta):
+        return self.df[["timestamp", "value"]]
+
+
+def generate(rows):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    sensors = np.array(["bme680", "bme280"])[np.arange(rows) % 2]
+    return pd.DataFrame({
+        "timestamp": pd.date_range(end=now, periods=rows, freq="10ms"),
+        "name": "env.temperature",
+        "value": np.random.uniform(10, 40, rows),
+        "meta": [{"sensor": s, "node": "000048B02D15BC7C"} for s in sensors],
+    })
+
+
+# the row-by-row extraction that Checker used before vectorization
+def iterrows_measurements(checker, df, name, meta):
+    return np.array([m["value"] for _, m in df.iterrows() if m["name"] == name and checker.matchmeta(meta, m["meta"])])
+
+
+def iterrows_rate(df):
+    return np.array([m["value"] for _, m in df.iterrows()])
+
+
+def measure(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(args):
+    logging.info(f'{"rows":>8} {"function":>8} {"iterrows (ms)":>14} {"vectorized (ms)":>16} {"speedup":>8}')
+    for rows in args.rows:
+        df = generate(rows)
+        checker = Checker(StaticDataBackbone(df))
+        meta = {"sensor": "bme680"}
+        cases = [
+            ("v", lambda: iterrows_measurements(checker, df, "env.temperature", meta), lambda: checker.get_measurements("env.temperature", **meta)),
+            ("rate", lambda: iterrows_rate(df[["timestamp", "value"]]), lambda: checker.rate("env.temperature")),
+        ]
+        for name, before, after in cases:
+            assert np.array_equal(before(), after())
+            t_before = measure(before, args.repeat)
+            t_after = measure(after, args.repeat)
+            logging.info(f'{rows:>8} {name:>8} {t_before * 1000:>14.2f} {t_after * 1000:>16.2f} {t_before / t_after:>7.1f}x')
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks extracting values in Checker.get_measurements and Checker.rate")
+    parser.add_argument("--rows",
+        dest="rows", type=int, nargs="+",
+        default=[1000, 10000, 100000],
+        help="number of rows returned from the backbone")
+    parser.add_argument("--repeat",
+        dest="repeat", type=int,
+        default=3,
+        help="number of runs per case; the best run is reported")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(message)s',
+        level=logging.INFO)
+    exit(run(args))
@@ -1,23 +1,121 @@
 from os import getenv
-import re
+import functools
+import json
+import threading
 
-import numpy as np
+from flask import Flask, Response, request
+from checker import Checker, InfluxDataBackbone, CachingDataBackbone, RedisDataBackbone, StreamingDataBackbone, RuleSubscriptions, Profile
 
-import redis
-from flask import Flask, request
-from checker import Checker, InfluxDataBackbone
-
-from prometheus_client import start_http_server, Histogram
+from prometheus_client import start_http_server, Histogram, Gauge, Counter
 
 REQUEST_TIME = Histogram('request_processing_seconds', 'Time spent processing request')
+STAGE_TIME = Histogram('rule_stage_seconds', 'Time spent in each stage of rule evaluation', ['stage'])
+FUNCTION_CALLS = Counter('rule_function_calls', 'Number of calls of supported functions in rules', ['function'])
+RULE_CACHE_HITS = Gauge('rule_cache_hits', 'Number of rule evaluations that reused a compiled rule', multiprocess_mode='livesum')
+RULE_CACHE_MISSES = Gauge('rule_cache_misses', 'Number of rule evaluations that compiled the rule', multiprocess_mode='livesum')
+DATA_CACHE_HITS = Gauge('data_cache_hits', 'Number of measurement requests served from cached windows', multiprocess_mode='livesum')
+DATA_CACHE_DELTAS = Gauge('data_cache_deltas', 'Number of measurement requests that fetched only new measurements of cached windows', multiprocess_mode='livesum')
+DATA_CACHE_MISSES = Gauge('data_cache_misses', 'Number of measurement requests that fetched a full window', multiprocess_mode='livesum')
+DATA_CACHE_EVICTIONS = Gauge('data_cache_evictions', 'Number of cached windows evicted to stay under the memory cap', multiprocess_mode='livesum')
+DATA_CACHE_BYTES = Gauge('data_cache_bytes', 'Estimated memory used by cached windows', multiprocess_mode='livesum')
+INFLUXDB_HEALTHY = Gauge('influxdb_healthy', 'Whether the last health check of InfluxDB succeeded', multiprocess_mode='livemin')
+INFLUXDB_RETRIES = Gauge('influxdb_request_retries', 'Number of InfluxDB requests retried after a transient failure', multiprocess_mode='livesum')
+INFLUXDB_LATENCY = Gauge('influxdb_request_latency_seconds_avg', 'Average latency of successful InfluxDB requests', multiprocess_mode='livemax')
+INFLUXDB_WRITES_DROPPED = Gauge('influxdb_writes_dropped', 'Number of measurements dropped from a full write queue or a failed write', multiprocess_mode='livesum')
+INFLUXDB_WRITES_REJECTED = Gauge('influxdb_writes_rejected', 'Number of measurements rejected as they can not be written', multiprocess_mode='livesum')
+SUBSCRIPTIONS = Gauge('rule_subscriptions', 'Number of subscribed rules', multiprocess_mode='livesum')
+SUBSCRIPTION_EVALUATIONS = Gauge('rule_subscription_evaluations', 'Number of evaluations of subscribed rules', multiprocess_mode='livesum')
+SUBSCRIPTION_NOTIFICATIONS = Gauge('rule_subscription_notifications', 'Number of changed results of subscribed rules', multiprocess_mode='livesum')
+INFLUXDB_CONNECTIONS = Gauge('influxdb_pool_connections', 'Number of connections opened by the InfluxDB connection pool', multiprocess_mode='livesum')
 
 app = Flask(__name__)
 port = getenv("SERVER_PORT", 5000)
 
-c = Checker(InfluxDataBackbone(
+influx = InfluxDataBackbone(
     getenv("NODE_INFLUXDB_URL", "http://wes-node-influxdb:8086"),
-    getenv("NODE_INFLUXDB_QUERY_TOKEN", "")
-))
+    getenv("NODE_INFLUXDB_QUERY_TOKEN", ""),
+    pool_size=int(getenv("INFLUXDB_POOL_SIZE", 10)),
+    retries=int(getenv("INFLUXDB_RETRIES", 3)))
+if getenv("REDIS_URL", "") != "":
+    import redis
+    # windows are shared with the other checkers using the same redis
+    backbone = RedisDataBackbone(
+        influx,
+        redis.Redis.from_url(getenv("REDIS_URL")),
+        ttl=float(getenv("DATA_CACHE_TTL", 60)))
+else:
+    backbone = CachingDataBackbone(
+        influx,
+        ttl=float(getenv("DATA_CACHE_TTL", 60)),
+        max_bytes=int(getenv("DATA_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+# aggregates and rates read new measurements directly from InfluxDB
+streaming = StreamingDataBackbone(backbone, source=influx, ttl=float(getenv("STREAMING_TTL", 300)), overlap=float(getenv("STREAMING_OVERLAP", 0)))
+c = Checker(streaming, scheduler_refresh_interval=float(getenv("SCHEDULER_REFRESH_INTERVAL", 1)))
+subscriptions = RuleSubscriptions(
+    c,
+    max_interval=float(getenv("SUBSCRIPTION_MAX_INTERVAL", 60)),
+    idle_timeout=float(getenv("SUBSCRIPTION_IDLE_TIMEOUT", 600)))
+SUBSCRIPTION_WAIT = float(getenv("SUBSCRIPTION_WAIT", 30))
+
+# gauges read from the state of this process
+GAUGE_FUNCTIONS = [
+    (RULE_CACHE_HITS, lambda: c.rule_cache.hits),
+    (RULE_CACHE_MISSES, lambda: c.rule_cache.misses),
+    (DATA_CACHE_HITS, lambda: backbone.hits),
+    (DATA_CACHE_DELTAS, lambda: backbone.deltas),
+    (DATA_CACHE_MISSES, lambda: backbone.misses),
+    (DATA_CACHE_EVICTIONS, lambda: backbone.evictions),
+    (DATA_CACHE_BYTES, lambda: backbone.size),
+    (INFLUXDB_HEALTHY, lambda: influx.healthy),
+    (INFLUXDB_RETRIES, lambda: influx.retried),
+    (INFLUXDB_LATENCY, lambda: influx.stats()["latency_avg"]),
+    (INFLUXDB_CONNECTIONS, lambda: influx.stats()["pool_connections"]),
+    (INFLUXDB_WRITES_DROPPED, lambda: influx.writer.dropped),
+    (INFLUXDB_WRITES_REJECTED, lambda: influx.writer.rejected),
+    (SUBSCRIPTIONS, lambda: subscriptions.stats()["subscriptions"]),
+    (SUBSCRIPTION_EVALUATIONS, lambda: subscriptions.evaluations),
+    (SUBSCRIPTION_NOTIFICATIONS, lambda: subscriptions.notifications),
+]
+# in multiprocess mode, metrics of all workers are collected from files in PROMETHEUS_MULTIPROC_DIR
+# and gauges are written there periodically instead of being read when scraped
+MULTIPROCESS = getenv("PROMETHEUS_MULTIPROC_DIR", "") != ""
+if not MULTIPROCESS:
+    for gauge, func in GAUGE_FUNCTIONS:
+        gauge.set_function(func)
+_stop = threading.Event()
+
+
+def update_gauges():
+    for gauge, func in GAUGE_FUNCTIONS:
+        gauge.set(func())
+
+
+def start():
+    """ Starts the background work of this process; called once per worker """
+    influx.start_health_check(float(getenv("INFLUXDB_HEALTH_CHECK_INTERVAL", 30)))
+    subscriptions.start(float(getenv("SUBSCRIPTION_POLL_INTERVAL", 1)))
+    if MULTIPROCESS:
+        def run(interval):
+            while not _stop.wait(interval):
+                update_gauges()
+        threading.Thread(target=run, args=(float(getenv("METRICS_UPDATE_INTERVAL", 5)),), name="metrics", daemon=True).start()
+
+
+def shutdown():
+    """ Stops the background work and writes the queued measurements """
+    _stop.set()
+    subscriptions.close()
+    influx.stop_health_check()
+    influx.writer.close(timeout=float(getenv("INFLUXDB_WRITE_CLOSE_TIMEOUT", 10)))
+    if MULTIPROCESS:
+        update_gauges()
+
+
+def record_profile(profile: Profile):
+    for stage, seconds in profile.stages.items():
+        STAGE_TIME.labels(stage).observe(seconds)
+    for function, count in profile.calls.items():
+        FUNCTION_CALLS.labels(function).inc(count)
 
 
 def generate_result(rule, success, message):
@@ -27,6 +125,30 @@ def generate_result(rule, success, message):
         "result" if success else "error": message,
     }
 
+
+# a subscription lives in the worker that made it, so with more than one worker a
+# request for it by id may reach another worker; it can then only be streamed
+# in the request that made it
+SUBSCRIPTIONS_BY_ID = int(getenv("SERVER_WORKERS", 1)) <= 1
+SUBSCRIPTIONS_BY_ID_DISABLED = "subscriptions by id need SERVER_WORKERS=1; subscribe with Accept: text/event-stream instead"
+
+
+def subscriptions_by_id(f):
+    """ Answers requests for subscriptions by id only if a single worker keeps them """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not SUBSCRIPTIONS_BY_ID:
+            return generate_result("", False, SUBSCRIPTIONS_BY_ID_DISABLED), 501
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def generate_subscription(subscription):
+    r = generate_result(subscription.rule, *subscription.result)
+    r["id"] = subscription.id
+    r["version"] = subscription.version
+    return r
+
 @app.route("/listrules", methods=["GET"])
 def listrules():
     return {
@@ -44,10 +166,123 @@ def evaluate():
     rule = j.get("rule", "")
     if rule == "":
         return generate_result(rule, False, "no rule is given")
-    ret, result = c.evaluate(rule)
-    return generate_result(rule, ret, result)
+    profile = Profile()
+    ret, result = c.evaluate(rule, profile)
+    record_profile(profile)
+    r = generate_result(rule, ret, result)
+    if request.args.get("profile") == "1":
+        r["profile"] = profile.to_dict()
+    return r
+
+
+@app.route("/evaluate_batch", methods=["POST"])
+@REQUEST_TIME.time()
+def evaluate_batch():
+    if request.content_type == None or not request.content_type.startswith("application/json"):
+        return generate_result("", False, "content_type must be application/json")
+    j = request.json
+    rules = j.get("rules", [])
+    if not isinstance(rules, list) or len(rules) < 1:
+        return generate_result("", False, "no rules are given")
+    if not all(isinstance(rule, str) and rule != "" for rule in rules):
+        return generate_result("", False, "rules must be non-empty strings")
+    profile = Profile()
+    results = c.evaluate_many(rules, profile)
+    record_profile(profile)
+    r = {
+        "response": "success",
+        "results": [generate_result(rule, ret, result) for rule, (ret, result) in zip(rules, results)],
+    }
+    if request.args.get("profile") == "1":
+        r["profile"] = profile.to_dict()
+    return r
         
 
+@app.route("/subscribe", methods=["POST"])
+def subscribe():
+    if request.content_type == None or not request.content_type.startswith("application/json"):
+        return generate_result("", False, "content_type must be application/json")
+    rule = request.json.get("rule", "")
+    if rule == "":
+        return generate_result(rule, False, "no rule is given")
+    if not isinstance(rule, str):
+        return generate_result("", False, "rule must be a string")
+    stream = request.accept_mimetypes.best == "text/event-stream"
+    if not stream and not SUBSCRIPTIONS_BY_ID:
+        return generate_result(rule, False, SUBSCRIPTIONS_BY_ID_DISABLED), 501
+    try:
+        subscription = subscriptions.subscribe(rule)
+    # ast.parse also raises ValueError for null bytes, and RecursionError or MemoryError for deeply nested rules
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as ex:
+        return generate_result(rule, False, str(ex))
+    # streaming it in the same request works with any number of workers and ends it when the client leaves
+    if stream:
+        return stream_subscription(subscription.id, unsubscribe=True)
+    return generate_subscription(subscription)
+
+
+@app.route("/subscriptions/<id>", methods=["GET"])
+@subscriptions_by_id
+def wait_subscription(id):
+    """ Long-polls for a result newer than the given version """
+    try:
+        version = int(request.args.get("version", 0))
+    except ValueError:
+        return generate_result("", False, "version must be an integer"), 400
+    try:
+        timeout = float(request.args.get("timeout", SUBSCRIPTION_WAIT))
+    except ValueError:
+        timeout = -1
+    if not timeout >= 0:
+        return generate_result("", False, "timeout must be a number of seconds, not negative"), 400
+    timeout = min(timeout, SUBSCRIPTION_WAIT)
+    subscription = subscriptions.wait(id, version, timeout)
+    if subscription is None:
+        return generate_result("", False, f'subscription {id} not found'), 404
+    return generate_subscription(subscription)
+
+
+@app.route("/subscriptions/<id>", methods=["DELETE"])
+@subscriptions_by_id
+def unsubscribe(id):
+    if not subscriptions.unsubscribe(id):
+        return generate_result("", False, f'subscription {id} not found'), 404
+    return {"response": "success", "id": id}
+
+
+def stream_subscription(id, unsubscribe=False):
+    """ Streams the results of a subscription as server-sent events """
+    def stream():
+        version = 0
+        try:
+            while True:
+                subscription = subscriptions.wait(id, version, SUBSCRIPTION_WAIT)
+                if subscription is None:
+                    return
+                if subscription.version > version:
+                    version = subscription.version
+                    yield f'id: {version}\ndata: {json.dumps(generate_subscription(subscription))}\n\n'
+                else:
+                    # keeps the connection open
+                    yield ": keep-alive\n\n"
+        finally:
+            if unsubscribe:
+                subscriptions.unsubscribe(id)
+    return Response(stream(), mimetype="text/event-stream")
+
+
+@app.route("/subscriptions/<id>/events", methods=["GET"])
+@subscriptions_by_id
+def subscription_events(id):
+    if subscriptions.get(id) is None:
+        return generate_result("", False, f'subscription {id} not found'), 404
+    return stream_subscription(id)
+
+
 if __name__ == "__main__":
     start_http_server(8000)
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    start()
+    try:
+        app.run(host='0.0.0.0', port=port)
+    finally:
+        shutdown()
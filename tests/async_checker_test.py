@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+import time
+import unittest
+
+from checker import MemoryDataBackbone
+from async_checker import AsyncChecker, AsyncDataBackbone, AsyncInfluxDataBackbone
+import checker_test
+
+
+class SlowDataBackbone(AsyncDataBackbone):
+    def __init__(self, measurements, delay):
+        self.backbone = MemoryDataBackbone(measurements)
+        self.delay = delay
+        self.requests = []
+
+    async def get_measurements(self, name, since="-1m", last=False, **meta):
+        self.requests.append(("get_measurements", name))
+        await asyncio.sleep(self.delay)
+        return self.backbone.get_measurements(name, since, last, **meta)
+
+    async def get_rate(self, name, since, window="1s", unit="1s", **meta):
+        self.requests.append(("get_rate", name))
+        await asyncio.sleep(self.delay)
+        return self.backbone.get_rate(name, since, window, unit, **meta)
+
+    async def get_aggregate(self, name, since, func, **meta):
+        self.requests.append(("get_aggregate", name))
+        await asyncio.sleep(self.delay)
+        return self.backbone.get_aggregate(name, since, func, **meta)
+
+
+class TestAsyncChecker(unittest.TestCase):
+    def setUp(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.backbone = SlowDataBackbone([
+            {"timestamp": now - datetime.timedelta(seconds=10), "name": "env.temperature", "value": 31.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(seconds=10), "name": "env.humidity", "value": 80.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(seconds=10), "name": "env.pressure", "value": 1000.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(minutes=2), "name": "sys.scheduler.plugin.lastexecution", "value": "myplugin", "meta": {}},
+        ], delay=0.2)
+        self.checker = AsyncChecker(self.backbone)
+
+    def test_concurrent_requests(self):
+        rule = "avg(v('env.temperature')) > 30 and any(v('env.humidity') > 70) and max(v('env.pressure')) > 900"
+        start = time.monotonic()
+        result = asyncio.run(self.checker.evaluate(rule))
+        elapsed = time.monotonic() - start
+        self.assertEqual(result, (True, True))
+        self.assertEqual(len(self.backbone.requests), 3)
+        # the three requests are sent at the same time
+        self.assertLess(elapsed, 0.5)
+
+    def test_requests_while_evaluating(self):
+        # the name is computed, so the request can only be sent while evaluating
+        result = asyncio.run(self.checker.evaluate("avg(v('env.' + 'temperature')) > 30"))
+        self.assertEqual(result, (True, True))
+        result = asyncio.run(self.checker.evaluate("v('env.temperature', sensor='bme280')"))
+        self.assertEqual(result, (False, "no data for env.temperature with meta {'sensor': 'bme280'} found"))
+
+    def test_evaluate_many(self):
+        results = asyncio.run(self.checker.evaluate_many([
+            "avg(v('env.temperature')) > 30",
+            "avg(v('env.temperature')) > 40",
+            "time(",
+        ]))
+        self.assertEqual(results[0], (True, True))
+        self.assertEqual(results[1], (True, False))
+        self.assertFalse(results[2][0])
+        self.assertEqual(len(self.backbone.requests), 1)
+
+    def test_invalid_rules(self):
+        # rules that fail to compile are reported by the evaluation, not while sending the queries
+        results = asyncio.run(self.checker.evaluate_many([
+            "-" * 100000 + "1 > 0",
+            "+".join(["1"] * 2000),
+            "1\x00 > 0",
+            "avg(v('env.temperature')) > 30",
+        ]))
+        self.assertEqual([ret for ret, _ in results], [False, False, False, True])
+
+
+class TestAsyncInfluxDataBackbone(unittest.TestCase):
+    def test_retry(self):
+        server = checker_test.StubInfluxDB(checker_test.TestInfluxDataBackbone.response, failures=2)
+        self.addCleanup(server.shutdown)
+        backbone = AsyncInfluxDataBackbone(server.url, "token", backoff=0)
+
+        async def run():
+            try:
+                df = await backbone.get_measurements("env.temperature")
+                self.assertEqual(list(df.value), [23.1])
+                stats = backbone.stats()
+                self.assertEqual((stats["requests"], stats["failures"], stats["retries"]), (1, 2, 2))
+                # InfluxDB is pinged after a failure
+                self.assertIn("/ping", server.paths)
+                server.failures = 5
+                with self.assertRaises(Exception):
+                    await backbone.get_measurements("env.temperature")
+                self.assertEqual(backbone.stats()["failures"], 6)
+                self.assertEqual(await backbone.push_measurements([{"name": "env.temperature", "value": 23.1}, {"name": "env.temperature"}]), 1)
+                self.assertEqual((backbone.written, backbone.rejected), (1, 1))
+            finally:
+                await backbone.close()
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,42 @@
 from os import getenv
 import datetime
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from checker import Checker, Profile, InfluxDataBackbone, FakeDataBackbone, MemoryDataBackbone, MeasurementBuffer, CachingDataBackbone, RedisDataBackbone, StreamingDataBackbone, RollingWindow, to_line_protocol, CronSchedule, RuleSubscriptions, get_meta
+
+
+class RecordingBackbone(FakeDataBackbone):
+    """ FakeDataBackbone that records the queries sent to it
+
+    queries holds (name, since, last, meta) of get_measurements and aggregations
+    (name, since, func, meta) of get_aggregate. If aggregates is given, get_aggregate
+    returns aggregates[func] instead of reducing the measurements.
+    """
+    def __init__(self, measurements, aggregates=None):
+        super().__init__(measurements)
+        self.aggregates = aggregates
+        self.queries = []
+        self.aggregations = []
+
+    def get_measurements(self, name, since="-1m", last=False, **meta):
+        self.queries.append((name, since, last, meta))
+        return super().get_measurements(name, since, last, **meta)
+
+    def get_aggregate(self, name, since, func, **meta):
+        self.aggregations.append((name, since, func, meta))
+        if self.aggregates is not None:
+            return self.aggregates[func]
+        return super().get_aggregate(name, since, func, **meta)
 
-from checker import Checker, InfluxDataBackbone, FakeDataBackbone
 
 @unittest.skipIf(getenv("NODE_INFLUXDB_URL", "") == "", "No inlufxDB specified.")
 class TestCheckerWithRealBackend(unittest.TestCase):
@@ -20,6 +54,7 @@ class TestCheckerWithRealBackend(unittest.TestCase):
             {"timestamp": datetime.datetime.now(datetime.timezone.utc), "name": "sys.uptime", "value": 3700, "meta": {}},
         ]
         self.backbone.push_measurements(measurements=measurements)
+        self.backbone.flush()
         # the avg returns 1 data point that its average is greater than 23
         self.assertTrue(self.checker.evaluate("avg(v('env.temperature', sensor='bme680')) > 23")[1])
         # the "since" returns 2 different data points that their average is less than 23
@@ -45,6 +80,177 @@ class TestCheckerFunctions(unittest.TestCase):
         # swapping parameters other than measurement name should not affect the result.
         self.assertFalse(checker.evaluate("avg(v('env.temperature', sensor='bme680', since='-2m')) > 23")[1])
 
+    def test_rule_cache(self):
+        checker = Checker(None, rule_cache_size=2)
+        self.assertEqual(checker.evaluate("1 + 2 == 3"), (True, True))
+        self.assertEqual(checker.evaluate("1 + 2 == 3"), (True, True))
+        self.assertEqual(checker.evaluate("2 > 3"), (True, False))
+        self.assertEqual(checker.rule_cache.hits, 1)
+        self.assertEqual(checker.rule_cache.misses, 2)
+        # the least recently used rule is dropped when the cache is full
+        checker.evaluate("3 > 2")
+        self.assertEqual(len(checker.rule_cache), 2)
+        checker.evaluate("1 + 2 == 3")
+        self.assertEqual(checker.rule_cache.misses, 4)
+        # invalid rules are reported, not cached
+        ret, _ = checker.evaluate("1 +")
+        self.assertFalse(ret)
+        self.assertEqual(len(checker.rule_cache), 2)
+
+    def test_evaluate_many(self):
+        measurements = [
+            {"timestamp": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1), "name": "env.temperature", "value": 23.1, "meta": {"sensor": "bme680"}},
+            {"timestamp": datetime.datetime.now(datetime.timezone.utc), "name": "env.temperature", "value": 41.2, "meta": {"sensor": "bme280"}},
+        ]
+        backbone = RecordingBackbone(measurements)
+        checker = Checker(backbone)
+        results = checker.evaluate_many([
+            "avg(v('env.temperature', sensor='bme680')) > 23",
+            "avg(v('env.temperature', sensor='bme680')) > 30",
+            "any(v('env.temperature') > 40)",
+            "any(v('env.temperature') > 50)",
+            "time(",
+        ])
+        self.assertEqual(results[0], (True, True))
+        self.assertEqual(results[1], (True, False))
+        self.assertEqual(results[2], (True, True))
+        self.assertEqual(results[3], (True, False))
+        self.assertFalse(results[4][0])
+        # rules with the same v() share the query
+        self.assertEqual(len(backbone.queries) + len(backbone.aggregations), 2)
+
+    def test_query_planner(self):
+        measurements = [
+            {"timestamp": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1), "name": "env.temperature", "value": 23.1, "meta": {"sensor": "bme680"}},
+            {"timestamp": datetime.datetime.now(datetime.timezone.utc), "name": "env.temperature", "value": 41.2, "meta": {"sensor": "bme280"}},
+        ]
+        backbone = RecordingBackbone(measurements, aggregates={"mean": 32.15, "max": 41.2, "count": 2})
+        checker = Checker(backbone)
+        self.assertTrue(checker.evaluate("avg(v('env.temperature', since='-5m')) > 30")[1])
+        self.assertTrue(checker.evaluate("max(v('env.temperature')) > 40 and len(v('env.temperature')) == 2")[1])
+        self.assertEqual(backbone.aggregations, [
+            ("env.temperature", "-5m", "mean", {}),
+            ("env.temperature", "-1m", "max", {}),
+            ("env.temperature", "-1m", "count", {}),
+        ])
+        # rules that can not be planned still read the measurements
+        self.assertTrue(checker.evaluate("avg(v('env.temperature', last=True)) > 30")[1])
+        self.assertEqual(len(backbone.aggregations), 3)
+
+        # FakeDataBackbone reduces the measurements in memory
+        checker = Checker(FakeDataBackbone(measurements))
+        self.assertEqual(checker.evaluate("min(v('env.temperature')) == 23.1"), (True, True))
+        self.assertEqual(checker.evaluate("sum(v('env.temperature', sensor='bme280')) == 41.2"), (True, True))
+        self.assertEqual(checker.evaluate("last(v('env.temperature')) == 41.2"), (True, True))
+        self.assertEqual(checker.evaluate("len(v('env.temperature', sensor='bme')) == 1")[1], "no data for env.temperature with meta {'sensor': 'bme'} found")
+
+    def test_query_planner_strings(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        measurements = [
+            {"timestamp": now - datetime.timedelta(seconds=s), "name": "sys.scheduler.plugin.lastexecution", "value": plugin, "meta": {}}
+            for s, plugin in [(20, "imagesampler"), (10, "p")]
+        ]
+
+        class NumbersOnlyBackbone(FakeDataBackbone):
+            def get_aggregate(self, name, since, func, **meta):
+                raise Exception(f'unsupported input type for {func} aggregate: string')
+
+        # planning does not change the result of rules over values that are not numbers
+        for backbone in [FakeDataBackbone(measurements), CachingDataBackbone(FakeDataBackbone(measurements)), NumbersOnlyBackbone(measurements)]:
+            checker = Checker(backbone)
+            self.assertEqual(checker.evaluate("max(v('sys.scheduler.plugin.lastexecution')) == 'p'"), (True, True))
+            self.assertEqual(checker.evaluate("min(v('sys.scheduler.plugin.lastexecution')) == 'imagesampler'"), (True, True))
+            self.assertFalse(checker.evaluate("avg(v('sys.scheduler.plugin.lastexecution')) == 'p'")[0])
+
+    def test_rule_engine(self):
+        measurements = [
+            {"timestamp": datetime.datetime.now(datetime.timezone.utc), "name": "env.temperature", "value": 23.1, "meta": {"sensor": "bme680"}},
+        ]
+        backbone = RecordingBackbone(measurements)
+        checker = Checker(backbone)
+        self.assertEqual(checker.evaluate("1 + 2 * 3 == 7 and 'a' in ['a', 'b'] and -1 < 0 <= 0"), (True, True))
+        self.assertEqual(checker.evaluate("any(v('env.temperature') > 20) if 1 < 2 else False"), (True, True))
+        self.assertEqual(checker.evaluate("v('env.temperature')[-1] == 23.1 and len(v('env.temperature')[:1]) == 1"), (True, True))
+        # and/or stop querying once the result is known
+        backbone.queries.clear()
+        self.assertEqual(checker.evaluate("False and any(v('env.temperature') > 20)"), (True, False))
+        self.assertEqual(checker.evaluate("time('hour') < 0 and any(v('env.temperature') > 20)"), (True, False))
+        self.assertEqual(checker.evaluate("True or any(v('env.temperature') > 20)"), (True, True))
+        self.assertEqual(len(backbone.queries), 0)
+        # anything outside of the grammar is rejected before the rule runs
+        for rule in [
+            "v('env.temperature').__class__ == 1",
+            "(lambda: True)()",
+            "__import__('os') == 1",
+            "open('/etc/passwd') == 1",
+            "x > 1",
+            "[t for t in v('env.temperature')] == []",
+            "max(*[1, 2]) == 2",
+            "v == v",
+        ]:
+            ret, message = checker.evaluate(rule)
+            self.assertFalse(ret, rule)
+        self.assertEqual(checker.evaluate("x > 1")[1], "name 'x' is not defined")
+        self.assertEqual(checker.evaluate("open('/etc/passwd') == 1")[1], "function open is not supported")
+        self.assertEqual(len(backbone.queries), 0)
+        # errors while evaluating are still reported
+        self.assertEqual(checker.evaluate("1 / 0 == 1"), (False, "division by zero"))
+        self.assertFalse(checker.evaluate("2 ** 10 ** 10 > 1")[0])
+
+    def test_rule_engine_limits(self):
+        checker = Checker(FakeDataBackbone([]))
+        start = datetime.datetime.now()
+        # neither compiling nor evaluating may take long or exhaust memory
+        for rule in [
+            "len('a' * 10**8) > 0",
+            "len(10**8 * [0]) > 0",
+            "len(['a' * 10**4] * 10**4) > 0",
+            "len(str([[0] * 10**4] * 10**4)) > 0",
+            "((10**999)**999)**2 > 0",
+            "(((10**999)**999)**999)**999 > 0",
+            "10**999 * 10**999 * 10**999 > 0",
+            "len(sum([[0] * 10**4] * 11, [])) > 0",
+            "len('%0999999999d' % 0) > 0",
+        ]:
+            ret, message = checker.evaluate(rule)
+            self.assertFalse(ret, rule)
+        self.assertLess((datetime.datetime.now() - start).total_seconds(), 1)
+        for rule in ["'ab' * 3 == 'ababab'", "sum([[1], [2]], []) == [1, 2]", "2 ** 10 == 1024", "7 % 3 == 1", "sum([1, 2.5]) == 3.5"]:
+            self.assertEqual(checker.evaluate(rule), (True, True), rule)
+        # _aggregate is only called by the planner
+        self.assertEqual(checker.evaluate("_aggregate('mean', 'env.temperature') > 0"), (False, "function _aggregate is not supported"))
+
+    def test_match(self):
+        checker = Checker(None)
+        # tags of InfluxDB records are columns, and also a part of meta
+        df = pd.DataFrame({
+            "name": ["env.temperature", "env.temperature", "env.humidity"],
+            "value": [10.0, 20.0, 30.0],
+            "sensor": ["bme680", "bme280", "bme680"],
+            "meta": [{"sensor": "bme680", "zone": "core"}, {"sensor": "bme280"}, {"sensor": "bme680", "zone": "core"}],
+        })
+        self.assertEqual(list(checker.match(df, "env.temperature", {})), [True, True, False])
+        self.assertEqual(list(checker.match(df, "env.temperature", {"sensor": "bme680"})), [True, False, False])
+        self.assertEqual(list(checker.match(df, "env.temperature", {"zone": "core"})), [True, False, False])
+        self.assertEqual(list(checker.match(df, "env.temperature", {"vsn": "W001"})), [False, False, False])
+
+    def test_profile(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        checker = Checker(FakeDataBackbone([
+            {"timestamp": now, "name": "env.temperature", "value": 23.1, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(minutes=2), "name": "sys.scheduler.plugin.lastexecution", "value": "myplugin", "meta": {}},
+        ]))
+        profile = Profile()
+        result = checker.evaluate("avg(v('env.temperature')) > 20 and any(v('env.temperature') > 20) and after('myplugin')", profile)
+        self.assertEqual(result, (True, True))
+        self.assertEqual(profile.calls, {"v": 2, "after": 1})
+        self.assertEqual(set(profile.stages.keys()), {"compile", "query", "conversion", "evaluation"})
+        self.assertTrue(all(t >= 0 for t in profile.stages.values()))
+        # a failed evaluation is profiled as well
+        profile = Profile()
+        self.assertFalse(checker.evaluate("v(", profile)[0])
+        self.assertEqual(list(profile.stages.keys()), ["compile"])
+
     def test_time(self):
         checker = Checker(None)
         target_hour = datetime.datetime.now(datetime.timezone.utc).hour
@@ -92,6 +298,46 @@ class TestCheckerFunctions(unittest.TestCase):
         _, result = checker.evaluate(f'after("myplugin", since=121)')
         self.assertEqual(result, False)
 
+    def test_scheduler_state(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        backbone = RecordingBackbone([
+            {"timestamp": now - datetime.timedelta(hours=2), "name": "sys.scheduler.plugin.lastexecution", "value": "myplugin", "meta": {}},
+        ])
+        checker = Checker(backbone, scheduler_refresh_interval=60)
+        self.assertEqual(checker.evaluate('after("myplugin", since=3600)'), (True, True))
+        self.assertEqual(checker.evaluate('after("myplugin", since=10000)'), (True, False))
+        self.assertEqual(checker.evaluate('after("notmyplugin")'), (True, False))
+        # each plugin is read once; later lookups are served from the index
+        self.assertEqual([q[1:] for q in backbone.queries], [
+            ("-30d", True, {"_value": "myplugin"}),
+            ("-30d", True, {"_value": "notmyplugin"}),
+        ])
+        # new executions are read from the backbone after refresh interval
+        backbone.push_measurements([{"timestamp": now, "name": "sys.scheduler.plugin.lastexecution", "value": "notmyplugin", "meta": {}}])
+        self.assertEqual(checker.evaluate('after("notmyplugin")'), (True, False))
+        checker.scheduler.refresh_interval = 0
+        self.assertEqual(checker.evaluate('after("notmyplugin", since="myplugin")'), (True, True))
+        self.assertEqual(backbone.queries[-1][2:], (False, {}))
+
+    def test_cron_schedule(self):
+        schedule = CronSchedule()
+        now = datetime.datetime(2022, 5, 1, 10, 29, 30, tzinfo=datetime.timezone.utc)
+        self.assertEqual(schedule.get_prev("*/30 * * * *", now), datetime.datetime(2022, 5, 1, 10, 0, tzinfo=datetime.timezone.utc))
+        now += datetime.timedelta(minutes=1)
+        self.assertEqual(schedule.get_prev("*/30 * * * *", now), datetime.datetime(2022, 5, 1, 10, 30, tzinfo=datetime.timezone.utc))
+        self.assertEqual(schedule.fire_times["*/30 * * * *"][1], datetime.datetime(2022, 5, 1, 11, 0, tzinfo=datetime.timezone.utc))
+        with self.assertRaises(Exception):
+            schedule.get_prev("* * *", now)
+        # after a long pause or a clock jump the fire times are computed from now
+        start = datetime.datetime.now()
+        schedule.get_prev("* * * * *", now)
+        now += datetime.timedelta(days=7, seconds=10)
+        self.assertEqual(schedule.get_prev("* * * * *", now), datetime.datetime(2022, 5, 8, 10, 30, tzinfo=datetime.timezone.utc))
+        now = now.replace(year=2032)
+        self.assertEqual(schedule.get_prev("* * * * *", now), datetime.datetime(2032, 5, 8, 10, 30, tzinfo=datetime.timezone.utc))
+        self.assertEqual(schedule.fire_times["* * * * *"][1], datetime.datetime(2032, 5, 8, 10, 31, tzinfo=datetime.timezone.utc))
+        self.assertLess((datetime.datetime.now() - start).total_seconds(), 0.5)
+
     def test_rate(self):
         measurements = [
             {"timestamp": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=290), "name": "env.raingauge.total_acc", "value": 13.0},
@@ -118,5 +364,479 @@ class TestCheckerFunctions(unittest.TestCase):
         self.assertTrue(result)
 
 
+class StubInfluxDB(ThreadingHTTPServer):
+    """ Answers Flux queries with a fixed CSV response; the first failures requests get 503 """
+    def __init__(self, response, failures=0):
+        self.response = response
+        self.failures = failures
+        self.paths = []
+        self.bodies = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(handler):
+                self.paths.append(handler.path)
+                handler.send_response(204)
+                handler.end_headers()
+
+            def do_POST(handler):
+                self.paths.append(handler.path)
+                self.bodies.append(handler.rfile.read(int(handler.headers.get("Content-Length", 0))))
+                if self.failures > 0:
+                    self.failures -= 1
+                    handler.send_response(503)
+                    handler.send_header("Content-Length", "0")
+                    handler.end_headers()
+                    return
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/csv")
+                handler.send_header("Content-Length", str(len(self.response)))
+                handler.end_headers()
+                handler.wfile.write(self.response)
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class TestInfluxDataBackbone(unittest.TestCase):
+    response = (
+        b",result,table,_start,_stop,_time,_value,_field,_measurement,sensor\r\n"
+        b",_result,0,2022-05-01T00:00:00Z,2022-05-01T00:01:00Z,2022-05-01T00:00:10Z,23.1,value,env.temperature,bme680\r\n"
+        b"\r\n"
+    )
+
+    def test_client_reuse(self):
+        server = StubInfluxDB(self.response)
+        self.addCleanup(server.shutdown)
+        backbone = InfluxDataBackbone(server.url, "token")
+        for _ in range(3):
+            self.assertEqual(list(backbone.get_measurements("env.temperature").value), [23.1])
+        # no ping before the queries and one connection for all of them
+        self.assertEqual([p.split("?")[0] for p in server.paths], ["/api/v2/query"] * 3)
+        stats = backbone.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["pool_connections"], 1)
+
+    def test_retry(self):
+        server = StubInfluxDB(self.response, failures=2)
+        self.addCleanup(server.shutdown)
+        backbone = InfluxDataBackbone(server.url, "token", backoff=0)
+        self.assertEqual(list(backbone.get_measurements("env.temperature").value), [23.1])
+        stats = backbone.stats()
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["retries"], 2)
+        # InfluxDB is pinged after a failure
+        self.assertIn("/ping", server.paths)
+        server.failures = 5
+        with self.assertRaises(Exception):
+            backbone.get_measurements("env.temperature")
+        self.assertEqual(backbone.stats()["failures"], 6)
+
+    def test_line_protocol(self):
+        self.assertEqual(
+            to_line_protocol({"timestamp": datetime.datetime(2022, 5, 1, tzinfo=datetime.timezone.utc), "name": "env.temperature", "value": 23.1, "meta": {"sensor": "bme 680", "zone": "a,b=c", "empty": ""}}),
+            "env.temperature,sensor=bme\\ 680,zone=a\\,b\\=c value=23.1 1651363200000000000")
+        self.assertEqual(to_line_protocol({"name": "sys.uptime", "value": 3700, "timestamp": 1}), "sys.uptime value=3700i 1")
+        self.assertEqual(to_line_protocol({"name": "sys.ok", "value": True}), "sys.ok value=true")
+        self.assertEqual(to_line_protocol({"name": "sys.scheduler.plugin.lastexecution", "value": 'say "hi"'}), 'sys.scheduler.plugin.lastexecution value="say \\"hi\\""')
+        for measurement in [{"value": 1.0}, {"name": "env.temperature"}, {"name": "env.temperature", "value": float("nan")}, {"name": "env.temperature", "value": [1]}]:
+            with self.assertRaises(Exception):
+                to_line_protocol(measurement)
+
+    def test_writer(self):
+        server = StubInfluxDB(b"")
+        self.addCleanup(server.shutdown)
+        backbone = InfluxDataBackbone(server.url, "token", write_batch_size=2, write_flush_interval=60)
+        measurements = [{"timestamp": i, "name": "env.temperature", "value": float(i), "meta": {"sensor": "bme680"}} for i in range(5)]
+        self.assertEqual(backbone.push_measurements(measurements + [{"name": "env.temperature"}]), 5)
+        self.assertTrue(backbone.flush(timeout=10))
+        writes = [b for p, b in zip(server.paths, server.bodies) if p.startswith("/api/v2/write")]
+        self.assertEqual(sorted(len(b.splitlines()) for b in writes), [1, 2, 2])
+        self.assertIn(b"env.temperature,sensor=bme680 value=4.0 4", b"\n".join(writes))
+        stats = backbone.stats()
+        self.assertEqual((stats["write_written"], stats["write_rejected"], stats["write_dropped"], stats["write_queued"]), (5, 1, 0, 0))
+
+        # measurements that do not fit in the queue or fail to be written are dropped
+        server.failures = 100
+        backbone = InfluxDataBackbone(server.url, "token", retries=0, backoff=0, write_batch_size=100, write_flush_interval=60, write_queue_size=3)
+        self.assertEqual(backbone.push_measurements(measurements), 3)
+        self.assertTrue(backbone.flush(timeout=10))
+        stats = backbone.stats()
+        self.assertEqual((stats["write_written"], stats["write_dropped"]), (0, 5))
+
+    def test_parse_csv(self):
+        backbone = InfluxDataBackbone("http://localhost:8086", "")
+        data = (
+            b",result,table,_start,_stop,_time,_value,_field,_measurement,sensor\r\n"
+            b",_result,0,2022-05-01T00:00:00Z,2022-05-01T00:01:00Z,2022-05-01T00:00:10.123456789Z,23.1,value,env.temperature,bme680\r\n"
+            b",_result,1,2022-05-01T00:00:00Z,2022-05-01T00:01:00Z,2022-05-01T00:00:20Z,41.2,value,env.temperature,bme280\r\n"
+            b"\r\n"
+            b",result,table,_start,_stop,_time,_value,_field,_measurement,sensor,zone\r\n"
+            b",_result,2,2022-05-01T00:00:00Z,2022-05-01T00:01:00Z,2022-05-01T00:00:30Z,30.5,value,env.temperature,bme680,core\r\n"
+            b"\r\n"
+        )
+        df = backbone.convert_to_api_record(backbone.parse_csv(data))
+        self.assertEqual(list(df.value), [23.1, 41.2, 30.5])
+        self.assertEqual(list(df.name.unique()), ["env.temperature"])
+        self.assertEqual(df.timestamp[0].nanosecond, 789)
+        self.assertEqual(get_meta(df), [{"sensor": "bme680"}, {"sensor": "bme280"}, {"sensor": "bme680", "zone": "core"}])
+        self.assertEqual(len(backbone.parse_csv(b"\r\n")), 0)
+        checker = Checker(None)
+        self.assertEqual(list(checker.match(df, "env.temperature", {"zone": "core"})), [False, False, True])
+
+    def test_parse_annotated_csv(self):
+        backbone = InfluxDataBackbone("http://localhost:8086", "")
+        data = (
+            b"#datatype,string,long,dateTime:RFC3339Nano,double,string,string,string\r\n"
+            b",result,table,_time,_value,_measurement,port,zone\r\n"
+            b",_result,0,2022-05-01T00:00:10Z,23.1,env.temperature,1,NA\r\n"
+            b",_result,1,2022-05-01T00:00:20Z,41.2,env.temperature,2,\r\n"
+            b"\r\n"
+            b"#datatype,string,long,dateTime:RFC3339Nano,string,string,string\r\n"
+            b",result,table,_time,_value,_measurement,plugin\r\n"
+            b",_result,2,2022-05-01T00:00:30Z,null,sys.scheduler.plugin.lastexecution,1\r\n"
+            b"\r\n"
+        )
+        df = backbone.convert_to_api_record(backbone.parse_csv(data))
+        self.assertEqual(list(df.value[:2]), [23.1, 41.2])
+        self.assertEqual(df.value[2], "null")
+        self.assertEqual(get_meta(df), [{"port": "1", "zone": "NA"}, {"port": "2"}, {"plugin": "1"}])
+        checker = Checker(None)
+        self.assertEqual(list(checker.match(df, "env.temperature", {"port": "1"})), [True, False, False])
+        self.assertEqual(list(checker.match(df, "env.temperature", {"zone": "NA"})), [True, False, False])
+        # without annotations tags are still kept as strings
+        df = backbone.parse_csv(b",result,table,_value,port\r\n,_result,0,NA,1\r\n")
+        self.assertEqual((df["_value"][0], df["port"][0]), ("NA", "1"))
+        # errors at runtime come as a table after the results sent so far
+        data += (
+            b"#datatype,string,string\r\n"
+            b",error,reference\r\n"
+            b",\"runtime error @1:1-1:10: unsupported input type for mean aggregate: string\",\r\n"
+            b"\r\n"
+        )
+        with self.assertRaisesRegex(Exception, "unsupported input type for mean aggregate"):
+            backbone.parse_csv(data)
+
+
+class TestMemoryDataBackbone(unittest.TestCase):
+    def test_buffer(self):
+        buffer = MeasurementBuffer(capacity=4, initial_size=1)
+        for t in [10, 20, 30, 40, 50]:
+            buffer.append(t, t / 10, {})
+        # the oldest measurement is overwritten once the buffer is full
+        self.assertEqual(list(buffer.slice(0, len(buffer))[0]), [20, 30, 40, 50])
+        self.assertEqual(buffer.bisect(30), 2)
+        self.assertEqual(buffer.bisect(5), 0)
+        self.assertEqual(buffer.bisect(50), 4)
+        # out-of-order measurements are kept in time order
+        buffer.append(35, 3.5, {})
+        timestamps, values, _ = buffer.slice(0, len(buffer))
+        self.assertEqual(list(timestamps), [30, 35, 40, 50])
+        self.assertEqual(list(values), [3.0, 3.5, 4.0, 5.0])
+
+    def test_measurements(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        backbone = MemoryDataBackbone([
+            {"timestamp": now - datetime.timedelta(minutes=5), "name": "env.temperature", "value": 10.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(seconds=30), "name": "env.temperature", "value": 20.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(seconds=10), "name": "env.temperature", "value": 30.0, "meta": {"sensor": "bme280"}},
+        ])
+        self.assertEqual(list(backbone.get_measurements("env.temperature").value), [20.0, 30.0])
+        self.assertEqual(list(backbone.get_measurements("env.temperature", since="-10m", sensor="bme680").value), [10.0, 20.0])
+        self.assertEqual(list(backbone.get_measurements("env.temperature", last=True).value), [30.0])
+        self.assertEqual(len(backbone.get_measurements("env.humidity")), 0)
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-10m", "mean"), 20.0)
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-10m", "last", sensor="bme680"), 20.0)
+        self.assertIsNone(backbone.get_aggregate("env.temperature", "-10m", "max", sensor="bme"))
+
+
+class TestCachingDataBackbone(unittest.TestCase):
+    def setUp(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.backbone = RecordingBackbone([
+            {"timestamp": now - datetime.timedelta(minutes=3), "name": "env.temperature", "value": 10.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(seconds=30), "name": "env.temperature", "value": 20.0, "meta": {"sensor": "bme680"}},
+            {"timestamp": now - datetime.timedelta(seconds=20), "name": "env.temperature", "value": 40.0, "meta": {"sensor": "bme280"}},
+        ])
+
+    def test_delta(self):
+        cache = CachingDataBackbone(self.backbone)
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-5m").value), [10.0, 20.0, 40.0])
+        self.backbone.push_measurements([{"name": "env.temperature", "value": 30.0, "meta": {"sensor": "bme680"}}])
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-5m").value), [10.0, 20.0, 40.0, 30.0])
+        # a shorter window is sliced from the cached one
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-1m").value), [20.0, 40.0, 30.0])
+        self.assertEqual((cache.hits, cache.deltas, cache.misses), (0, 2, 1))
+        # only the measurements since the latest cached one are fetched again
+        self.assertEqual(self.backbone.queries[0], ("env.temperature", "-5m", False, {}))
+        self.assertLessEqual(int(self.backbone.queries[1][1][1:-1]), 22)
+        self.assertLessEqual(int(self.backbone.queries[2][1][1:-1]), 2)
+        # a longer window is fetched fully
+        cache.get_measurements("env.temperature", since="-10m")
+        self.assertEqual(self.backbone.queries[-1], ("env.temperature", "-10m", False, {}))
+        # aggregates of windows that would be queried again are reduced by the backbone
+        queries = len(self.backbone.queries)
+        self.assertEqual(cache.get_aggregate("env.temperature", "-1m", "mean", sensor="bme680"), 25.0)
+        self.assertEqual(cache.get_aggregate("env.temperature", "-1m", "last"), 30.0)
+        self.assertEqual(len(self.backbone.queries), queries)
+
+    def test_min_interval(self):
+        cache = CachingDataBackbone(self.backbone, min_interval=60)
+        cache.get_measurements("env.temperature", since="-5m")
+        self.assertEqual(cache.get_aggregate("env.temperature", "-1m", "max"), 40.0)
+        self.assertEqual(cache.get_measurements("env.temperature", since="-5m").value.sum(), 70.0)
+        self.assertEqual((cache.hits, cache.deltas, cache.misses), (2, 0, 1))
+        self.assertEqual(len(self.backbone.queries), 1)
+
+    def test_ttl_and_eviction(self):
+        cache = CachingDataBackbone(self.backbone, ttl=0)
+        cache.get_measurements("env.temperature", since="-5m")
+        cache.get_measurements("env.temperature", since="-5m")
+        self.assertEqual(cache.misses, 2)
+        cache = CachingDataBackbone(self.backbone, ttl=60, ttls={"env.temperature": 0})
+        cache.get_measurements("env.temperature", since="-5m")
+        cache.get_measurements("env.temperature", since="-5m")
+        self.assertEqual(cache.misses, 2)
+        cache = CachingDataBackbone(self.backbone, max_bytes=1)
+        cache.get_measurements("env.temperature", since="-5m", sensor="bme680")
+        cache.get_measurements("env.temperature", since="-5m", sensor="bme280")
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache.windows), 1)
+
+    def test_last(self):
+        cache = CachingDataBackbone(self.backbone)
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-5m", last=True, sensor="bme680").value), [20.0])
+        self.backbone.push_measurements([{"name": "env.temperature", "value": 30.0, "meta": {"sensor": "bme680"}}])
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-5m", last=True, sensor="bme680").value), [30.0])
+        self.assertEqual(cache.deltas, 1)
+
+
+@unittest.skipIf(getenv("REDIS_URL", "") == "" and fakeredis is None, "No redis or fakeredis available.")
+class TestRedisDataBackbone(unittest.TestCase):
+    setUp = TestCachingDataBackbone.setUp
+
+    def create_client(self):
+        if getenv("REDIS_URL", "") != "":
+            import redis
+            client = redis.Redis.from_url(getenv("REDIS_URL"))
+        else:
+            if not hasattr(self, "server"):
+                self.server = fakeredis.FakeServer()
+            client = fakeredis.FakeRedis(server=self.server)
+        return client
+
+    def create_cache(self, **kargs):
+        cache = RedisDataBackbone(self.backbone, self.create_client(), prefix="sciencerule-test", **kargs)
+        self.addCleanup(cache.clear)
+        return cache
+
+    def test_shared_windows(self):
+        cache = self.create_cache()
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-5m").value), [10.0, 20.0, 40.0])
+        self.backbone.push_measurements([{"name": "env.temperature", "value": 30.0, "meta": {"sensor": "bme680"}}])
+        # another checker reads the window and fetches only the new measurements
+        other = self.create_cache()
+        self.assertEqual(list(other.get_measurements("env.temperature", since="-5m").value), [10.0, 20.0, 40.0, 30.0])
+        self.assertEqual(list(cache.get_measurements("env.temperature", since="-1m").value), [20.0, 40.0, 30.0])
+        self.assertEqual((cache.misses, other.misses, other.deltas), (1, 0, 1))
+        self.assertEqual(self.backbone.queries[0], ("env.temperature", "-5m", False, {}))
+        self.assertLessEqual(int(self.backbone.queries[1][1][1:-1]), 22)
+        self.assertEqual(other.get_aggregate("env.temperature", "-1m", "mean", sensor="bme680"), 25.0)
+        self.assertEqual(other.get_aggregate("env.temperature", "-1m", "last"), 30.0)
+        # a window fetched within min_interval by any checker is reduced without a query
+        queries = len(self.backbone.queries)
+        self.assertEqual(self.create_cache(min_interval=60).get_aggregate("env.temperature", "-1m", "max"), 40.0)
+        self.assertEqual(len(self.backbone.queries), queries)
+        self.assertEqual(other.get_measurements("env.temperature", since="-1m").meta.tolist()[-1], {"sensor": "bme680"})
+
+    def test_ttl(self):
+        cache = self.create_cache(ttl=0)
+        cache.get_measurements("env.temperature", since="-5m")
+        cache.get_measurements("env.temperature", since="-5m")
+        self.assertEqual(cache.misses, 2)
+        # a longer window is fetched fully
+        cache = self.create_cache()
+        cache.get_measurements("env.temperature", since="-1m")
+        cache.get_measurements("env.temperature", since="-5m")
+        self.assertEqual(cache.misses, 2)
+        # measurements of a window that was empty when fetched fully expire with it
+        self.assertEqual(len(cache.get_measurements("env.humidity", since="-5m")), 0)
+        self.backbone.push_measurements([{"name": "env.humidity", "value": 50.0, "meta": {"sensor": "bme680"}}])
+        self.assertEqual(list(cache.get_measurements("env.humidity", since="-5m").value), [50.0])
+        self.assertEqual(cache.deltas, 1)
+        self.assertTrue(0 < cache.client.ttl(cache._key("env.humidity", {}, False)) <= cache.ttl)
+
+    def test_last_executions(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.backbone.push_measurements([{"timestamp": now - datetime.timedelta(seconds=10), "name": "sys.scheduler.plugin.lastexecution", "value": "imagesampler", "meta": {}}])
+        cache = self.create_cache()
+        self.assertEqual(Checker(cache).evaluate("after('imagesampler')"), (True, True))
+        # the last execution is served from redis to another checker
+        queries = len(self.backbone.queries)
+        self.assertEqual(Checker(self.create_cache()).evaluate("after('imagesampler')"), (True, True))
+        self.assertTrue(self.backbone.queries[queries][2])
+        self.assertLessEqual(int(self.backbone.queries[queries][1][1:-1]), 12)
+
+
+class TestStreamingDataBackbone(unittest.TestCase):
+    def test_rolling_window(self):
+        window = RollingWindow()
+        for t, v in enumerate([5., 1., 4., 2., 3.]):
+            window.add(t, v)
+        self.assertEqual((window.get("min"), window.get("max"), window.get("sum")), (1., 5., 15.))
+        window.evict(1)
+        self.assertEqual((window.get("min"), window.get("max"), window.get("mean"), window.get("last")), (2., 4., 3., 3.))
+        window.evict(4)
+        self.assertIsNone(window.get("count"))
+
+    def test_aggregate(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        source = MemoryDataBackbone([
+            {"timestamp": now - datetime.timedelta(seconds=s), "name": "env.temperature", "value": float(s), "meta": {"sensor": "bme680"}}
+            for s in [200, 100, 50, 10]
+        ])
+        backbone = StreamingDataBackbone(source)
+        # the first request is reduced by the backbone; the state is built when requested again soon
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-2m", "mean", sensor="bme680"), 160 / 3)
+        self.assertEqual(backbone.ingested, 0)
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-2m", "max", sensor="bme680"), 100.)
+        self.assertIsNone(backbone.get_aggregate("env.temperature", "-2m", "max", sensor="bme280"))
+        # aggregates of the same window share the state
+        self.assertEqual(backbone.ingested, 3)
+        source.push_measurements([{"timestamp": now, "name": "env.temperature", "value": 2.0, "meta": {"sensor": "bme680"}}])
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-2m", "mean", sensor="bme680"), 162 / 4)
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-2m", "min", sensor="bme680"), 2.)
+        # only the new measurement is ingested again
+        self.assertEqual(backbone.ingested, 4)
+        checker = Checker(backbone)
+        self.assertEqual(checker.evaluate("avg(v('env.temperature', since='-2m', sensor='bme680')) > 40"), (True, True))
+        # a state not requested within half of its window is dropped, as reading the new measurements would cost as much as the window
+        key = backbone._key("aggregate", "env.temperature", "-2m", sensor="bme680")
+        backbone.states[key]["latest"] -= 61 * 10 ** 9
+        self.assertEqual(backbone.get_aggregate("env.temperature", "-2m", "mean", sensor="bme680"), 162 / 4)
+        self.assertIsNone(backbone.states[key]["fetched_at"])
+        self.assertEqual(backbone.ingested, 4)
+
+    def test_rate(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # the accumulation increases 1 every 10 seconds, that is 6 per minute
+        source = MemoryDataBackbone([
+            {"timestamp": now - datetime.timedelta(seconds=s), "name": "env.raingauge.total_acc", "value": 100 - s / 10}
+            for s in range(290, 120, -10)
+        ])
+        backbone = StreamingDataBackbone(source)
+        df = backbone.get_rate("env.raingauge.total_acc", "-5m", window="1m", unit="1m")
+        self.assertEqual({round(r, 6) for r in df.value.dropna()}, {6.0})
+        # then 3 every 10 seconds, 18 per minute
+        source.push_measurements([
+            {"timestamp": now - datetime.timedelta(seconds=s), "name": "env.raingauge.total_acc", "value": 87 + (130 - s) * 0.3}
+            for s in range(120, -10, -10)
+        ])
+        df = backbone.get_rate("env.raingauge.total_acc", "-5m", window="1m", unit="1m")
+        self.assertEqual(round(df.value.max(), 6), 18.0)
+        self.assertEqual(backbone.ingested, 17 + 13)
+        checker = Checker(backbone)
+        self.assertEqual(checker.evaluate("any(rate('env.raingauge.total_acc', since='-5m', window='1m', unit='1m') > 10)"), (True, True))
+
+    def test_series(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # two gauges interleaved, each increasing 6 per minute from a different level
+        measurement = lambda s, sensor, value: {"timestamp": now - datetime.timedelta(seconds=s), "name": "env.raingauge.total_acc", "value": value, "meta": {"sensor": sensor}}
+        source = MemoryDataBackbone(
+            [measurement(s, "a", 100 - s / 10) for s in range(290, 120, -10)] +
+            [measurement(s - 5, "b", 5000 - s / 10) for s in range(290, 120, -10)]
+        )
+        backbone = StreamingDataBackbone(source, overlap=60)
+        # rates are computed per series and summed in each window, as aggregate.rate does
+        df = backbone.get_rate("env.raingauge.total_acc", "-5m", window="1m", unit="1m")
+        self.assertEqual(round(df.value.max(), 6), 12.0)
+        self.assertTrue({round(r, 6) for r in df.value.dropna()} <= {6.0, 12.0})
+        self.assertEqual(len(df), len(df.timestamp.unique()))
+        backbone.get_aggregate("env.raingauge.total_acc", "-5m", "max")
+        self.assertEqual(backbone.get_aggregate("env.raingauge.total_acc", "-5m", "max"), 4987.)
+        # a measurement of one series written after a newer one of another is seen within overlap
+        source.push_measurements([measurement(0, "b", 5000.)])
+        self.assertEqual(backbone.get_aggregate("env.raingauge.total_acc", "-5m", "last"), 5000.)
+        source.push_measurements([measurement(30, "a", 2.)])
+        self.assertEqual(backbone.get_aggregate("env.raingauge.total_acc", "-5m", "min"), 2.)
+        self.assertEqual(backbone.get_aggregate("env.raingauge.total_acc", "-5m", "last"), 5000.)
+
+    def test_not_numeric(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        source = MemoryDataBackbone([
+            {"timestamp": now - datetime.timedelta(seconds=10), "name": "sys.scheduler.plugin.lastexecution", "value": "p", "meta": {}},
+        ])
+        checker = Checker(StreamingDataBackbone(source))
+        self.assertEqual(checker.evaluate("last(v('sys.scheduler.plugin.lastexecution')) == 'p'"), (True, True))
+        self.assertEqual(checker.evaluate("len(v('sys.scheduler.plugin.lastexecution')) == 1"), (True, True))
+
+class TestRuleSubscriptions(unittest.TestCase):
+    def measurement(self, name, value, seconds=0):
+        return {"timestamp": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=seconds), "name": name, "value": value, "meta": {}}
+
+    def test_dependencies(self):
+        checker = Checker(MemoryDataBackbone())
+        subscriptions = RuleSubscriptions(checker)
+        get = lambda rule: subscriptions.get_dependencies(checker.rule_cache.get(rule))
+        self.assertEqual(get("avg(v('env.temperature')) > 30 and any(rate('env.raingauge', since='-5m') > 0)"), {"env.temperature", "env.raingauge"})
+        self.assertEqual(get("after('imagesampler', since='motion-detector')"), {"sys.scheduler.plugin.lastexecution"})
+        self.assertIsNone(get("time('hour') > 6"))
+        self.assertIsNone(get("cronjob('imagesampler', '* * * * *')"))
+        self.assertIsNone(get("after('imagesampler', since=300)"))
+        self.assertIsNone(get("any(v('env.' + 'temperature') > 30)"))
+
+    def test_subscribe(self):
+        backbone = MemoryDataBackbone([
+            self.measurement("env.temperature", 20., 10),
+            self.measurement("env.relative_humidity", 50., 10),
+        ])
+        subscriptions = RuleSubscriptions(Checker(backbone))
+        hot = subscriptions.subscribe("max(v('env.temperature')) > 30")
+        humid = subscriptions.subscribe("max(v('env.relative_humidity')) > 80")
+        dynamic = subscriptions.subscribe("time('hour') >= 0")
+        self.assertEqual((hot.result, hot.version), ((True, False), 1))
+        self.assertEqual(dynamic.result, (True, True))
+        self.assertEqual(subscriptions.evaluations, 3)
+        with self.assertRaises(SyntaxError):
+            subscriptions.subscribe("max(v('env.temperature')) >")
+
+        # the existing measurements are seen first; afterwards only new ones cause evaluations
+        subscriptions.poll()
+        subscriptions.poll()
+        self.assertEqual(subscriptions.evaluations, 3 + 3 + 1)
+
+        backbone.push_measurements([self.measurement("env.temperature", 35.)])
+        subscriptions.poll()
+        self.assertEqual(subscriptions.evaluations, 7 + 2)
+        self.assertEqual((hot.result, hot.version), ((True, True), 2))
+        self.assertEqual(humid.version, 1)
+        self.assertEqual(subscriptions.notifications, 4)
+
+        # waiting returns at once for a newer version, else on timeout
+        self.assertIs(subscriptions.wait(hot.id, version=1, timeout=5), hot)
+        self.assertEqual(subscriptions.wait(humid.id, version=1, timeout=0.01).version, 1)
+        waiter = threading.Thread(target=lambda: self.assertEqual(subscriptions.wait(humid.id, version=1, timeout=5).version, 2))
+        waiter.start()
+        backbone.push_measurements([self.measurement("env.relative_humidity", 90.)])
+        subscriptions.poll()
+        waiter.join()
+
+        self.assertTrue(subscriptions.unsubscribe(hot.id))
+        self.assertFalse(subscriptions.unsubscribe(hot.id))
+        self.assertIsNone(subscriptions.wait(hot.id, timeout=0.01))
+        self.assertEqual(subscriptions.stats()["subscriptions"], 2)
+        # closing ends the waits of clients
+        waiter = threading.Thread(target=lambda: self.assertIsNone(subscriptions.wait(humid.id, version=2, timeout=5)))
+        waiter.start()
+        subscriptions.close()
+        waiter.join()
+        self.assertEqual(subscriptions.stats()["subscriptions"], 0)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import json
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+HEAVY_MODULES = ["numpy", "pandas", "influxdb_client", "croniter"]
+
+# measure runs code in a new interpreter and returns its time, peak RSS and the heavy modules it imported
+MEASURE = """
+import json, resource, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+seconds = time.perf_counter() - start
+# ru_maxrss is inherited across exec on Linux; VmHWM is the peak of this process only
+try:
+    with open("/proc/self/status") as f:
+        rss = [int(line.split()[1]) for line in f if line.startswith("VmHWM:")][0]
+except OSError:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "seconds": seconds,
+    "rss_mb": rss / 1024,
+    "modules": [m for m in %r if m in sys.modules],
+}))
+""" % HEAVY_MODULES
+
+
+def measure(code) -> dict:
+    out = subprocess.run([sys.executable, "-c", MEASURE, code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+class TestStartup(unittest.TestCase):
+    scalar_rules = "\n".join([
+        "import checker",
+        "c = checker.Checker(checker.MemoryDataBackbone())",
+        "assert c.evaluate(\"time('hour') >= 0 and 1 + 2 == 3\") == (True, True)",
+        "assert c.evaluate(\"any([time('minute') < 60, False])\") == (True, True)",
+    ])
+
+    def test_lazy_imports(self):
+        self.assertEqual(measure("import checker")["modules"], [])
+        self.assertEqual(measure("import checker; checker.InfluxDataBackbone('http://localhost:8086', '')")["modules"], [])
+        self.assertEqual(measure(self.scalar_rules)["modules"], [])
+        self.assertEqual(measure("import checker; assert checker.Checker(None).evaluate(\"cronjob('', '* * * * *')\") == (True, True)")["modules"], ["croniter"])
+
+    def test_startup_time(self):
+        scalar = measure(self.scalar_rules)
+        pandas = measure("import pandas")
+        # evaluating scalar rules from a cold start must not cost as much as loading pandas
+        self.assertLess(scalar["seconds"], pandas["seconds"] / 2)
+
+    def test_memory(self):
+        scalar = measure(self.scalar_rules)
+        pandas = measure("import pandas")
+        self.assertLess(scalar["rss_mb"], pandas["rss_mb"] * 0.6)
+
+
+if __name__ == "__main__":
+    unittest.main()